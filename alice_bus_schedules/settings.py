@@ -133,5 +133,49 @@ STATIC_URL = '/static/'
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
 CRONJOBS = [
-    ('0 3 * * *', 'core.cron.update_db')
+    ('30 2 * * *', 'core.cron.discover_routes'),
+    ('*/10 * * * *', 'core.cron.refresh_routes'),
 ]
+
+# Routes whose page did not change get their timetables re-downloaded at least this often
+FULL_CRAWL_INTERVAL_DAYS = 7
+
+# Alice drops webhook responses that take longer than this many seconds
+ALICE_RESPONSE_TIMEOUT = 3
+# Part of the Alice deadline kept for everything except live timetable requests
+UPSTREAM_RESERVED_TIME = 0.5
+# A hedged request is sent when the previous one has not answered within this many seconds
+UPSTREAM_HEDGE_DELAY = 0.5
+UPSTREAM_MAX_ATTEMPTS = 3
+UPSTREAM_MAX_WORKERS = 16
+UPSTREAM_FAILURE_THRESHOLD = 5
+UPSTREAM_RECOVERY_TIMEOUT = 30
+
+# City used for users that have not chosen one
+DEFAULT_CITY = 'brest'
+# (city, transport) pairs crawled from kogda.by, each one is crawled as a separate shard
+CRAWL_SHARDS = [
+    ('brest', 'autobus'),
+    ('brest', 'trolleybus'),
+]
+CRAWL_PROCESSES = 4
+# Failed crawl units are retried this many times before the run is left for the next crawl to resume
+CRAWL_UNIT_ATTEMPTS = 3
+# Unfinished crawl runs older than this are abandoned instead of resumed
+CRAWL_RUN_MAX_AGE_HOURS = 12
+# Seconds between checks whether the data in the database changed since in-memory caches were filled
+DATA_VERSION_CHECK_SECONDS = 30
+
+# Routes are refreshed in small batches spread over the day instead of one nightly crawl
+REFRESH_INTERVAL_HOURS = 24
+# Routes with a bus stop remembered by some user are refreshed more often
+PRIORITY_REFRESH_INTERVAL_HOURS = 6
+REFRESH_BATCH_SIZE = 5
+REFRESH_TICK_SECONDS = 600
+REFRESH_REQUESTS_PER_SECOND = 2
+# A route that failed to refresh is retried after this many minutes, doubling after every further failure
+REFRESH_RETRY_MINUTES = 10
+
+DEPARTURES_DEFAULT_LIMIT = 3
+DEPARTURES_MAX_LIMIT = 20
+DEPARTURES_MAX_STOPS = 100
@@ -8,9 +8,15 @@ https://docs.djangoproject.com/en/3.2/howto/deployment/wsgi/
 """
 
 import os
+from importlib import import_module
 
+from django.conf import settings
 from django.core.wsgi import get_wsgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'alice_bus_schedules.settings')
 
 application = get_wsgi_application()
+
+# Load the URLconf, and with it the views and the libraries they use, right away instead of on the first request.
+# Servers that load the application before forking workers (gunicorn --preload) then share it between all workers
+import_module(settings.ROOT_URLCONF)
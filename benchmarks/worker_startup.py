@@ -0,0 +1,145 @@
+"""Measures how long a freshly forked web worker takes to answer its first Alice request and how much memory it uses.
+
+The script plays the part of a server that loads the application before forking workers (gunicorn --preload,
+uWSGI without lazy-apps): it imports the WSGI module once, then forks one worker per run, and every worker serves
+a single "when is bus N at stop X" request through the WSGI application. The database is a temporary SQLite file
+with one route in it, and the live timetable budget is zero, so nothing goes over the network and the answer comes
+from stored trips.
+
+Memory is read in the worker after the request. Max RSS also counts the pages inherited from the parent, so the
+script reports the pages only the worker holds as well: Private_Dirty and USS (Private_Clean + Private_Dirty) from
+/proc/self/smaps_rollup, which makes it Linux only.
+
+Run from the repository root:
+
+    python benchmarks/worker_startup.py --runs 20
+"""
+import argparse
+import io
+import json
+import os
+import resource
+import statistics
+import sys
+import tempfile
+import time
+from pathlib import Path
+from wsgiref.util import setup_testing_defaults
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+HEAVY_MODULES = ['aiohttp', 'bs4', 'fuzzywuzzy', 'humanize', 'requests']
+TOKENS = ["когда", "будет", "автобус", "1", "на", "вокзал", "в", "сторону", "центр"]
+
+
+def load_application(database_name):
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'alice_bus_schedules.settings')
+    from django.conf import settings
+    settings.DATABASES = {'default': {'ENGINE': 'django.db.backends.sqlite3', 'NAME': database_name}}
+    settings.ALICE_RESPONSE_TIMEOUT = settings.UPSTREAM_RESERVED_TIME
+    start = time.perf_counter()
+    from alice_bus_schedules.wsgi import application
+    return application, time.perf_counter() - start
+
+
+def create_route():
+    from django.core.management import call_command
+    from core.models import DAY_TYPES, Bus, BusStop, Direction
+    from core.trips import save_trips
+    call_command('migrate', verbosity=0)
+    bus = Bus.objects.create(name='1', city='brest', transport='autobus')
+    direction = Direction.objects.create(name='Вокзал - Рынок', bus=bus)
+    bus_stops = [
+        BusStop.objects.create(name=name, direction=direction, position=position)
+        for position, name in enumerate(['Вокзал', 'Центр', 'Рынок'])
+    ]
+    departures = range(5 * 60, 23 * 60, 15)
+    timetables = [
+        [f"{(x + offset) // 60 % 24:02d}:{(x + offset) % 60:02d}" for x in departures] for offset in (0, 7, 15)
+    ]
+    for day_type, _ in DAY_TYPES:
+        save_trips(direction, day_type, bus_stops, timetables)
+
+
+def get_memory():
+    memory = {'max_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss}
+    with open('/proc/self/smaps_rollup') as smaps:
+        for line in smaps:
+            name, _, value = line.partition(':')
+            if name in ('Private_Clean', 'Private_Dirty'):
+                memory[name] = int(value.split()[0])
+    memory['private_dirty_kb'] = memory.pop('Private_Dirty')
+    memory['uss_kb'] = memory.pop('Private_Clean') + memory['private_dirty_kb']
+    return memory
+
+
+def serve_request(application):
+    body = json.dumps({
+        'version': '1.0',
+        'session': {'user': {'user_id': 'benchmark'}},
+        'request': {'nlu': {'tokens': TOKENS}},
+    }).encode()
+    environ = {
+        'REQUEST_METHOD': 'POST',
+        'PATH_INFO': '/',
+        'CONTENT_TYPE': 'application/json',
+        'CONTENT_LENGTH': str(len(body)),
+        'wsgi.input': io.BytesIO(body),
+    }
+    setup_testing_defaults(environ)
+    statuses = []
+    content = b''.join(application(environ, lambda status, headers: statuses.append(status)))
+    return statuses[0], json.loads(content)['response']['text']
+
+
+def run_worker(application):
+    read_fd, write_fd = os.pipe()
+    start = time.perf_counter()
+    pid = os.fork()
+    if pid == 0:
+        os.close(read_fd)
+        loaded_modules = set(sys.modules)
+        status, text = serve_request(application)
+        result = {
+            'seconds': time.perf_counter() - start,
+            'status': status,
+            'text': text,
+            'imported_modules': len(set(sys.modules) - loaded_modules),
+            'imported_heavy_modules': [
+                name for name in HEAVY_MODULES if name not in loaded_modules and name in sys.modules
+            ],
+            **get_memory(),
+        }
+        with os.fdopen(write_fd, 'w') as output:
+            json.dump(result, output)
+        os._exit(0)
+    os.close(write_fd)
+    with os.fdopen(read_fd) as output:
+        result = json.load(output)
+    os.waitpid(pid, 0)
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--runs', type=int, default=20)
+    args = parser.parse_args()
+    with tempfile.TemporaryDirectory() as directory:
+        application, load_time = load_application(str(Path(directory) / 'benchmark.sqlite3'))
+        create_route()
+        from django.db import connections
+        connections.close_all()
+        results = [run_worker(application) for _ in range(args.runs)]
+    print(f"answer: {results[0]['status']} {results[0]['text']}")
+    print(f"application load before fork: {load_time * 1000:.1f} ms")
+    print(f"first request in a new worker: median {statistics.median(x['seconds'] for x in results) * 1000:.1f} ms, "
+          f"max {max(x['seconds'] for x in results) * 1000:.1f} ms")
+    for name, key in (('max RSS', 'max_rss_kb'), ('Private_Dirty', 'private_dirty_kb'), ('USS', 'uss_kb')):
+        print(f"worker {name}: median {statistics.median(x[key] for x in results) / 1024:.1f} MB")
+    print(f"modules imported by the worker: {results[0]['imported_modules']}")
+    print(f"heavy modules imported by the worker: {', '.join(results[0]['imported_heavy_modules']) or 'none'}")
+
+
+if __name__ == '__main__':
+    main()
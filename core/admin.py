@@ -1,8 +1,12 @@
 from django.contrib import admin
-from .models import Bus, BusStop, Direction, YandexUser
+from .models import Bus, BusStop, CrawlRun, CrawlUnit, Direction, Trip, TripException, YandexUser
 
 
 admin.site.register(Bus)
 admin.site.register(BusStop)
+admin.site.register(CrawlRun)
+admin.site.register(CrawlUnit)
 admin.site.register(Direction)
+admin.site.register(Trip)
+admin.site.register(TripException)
 admin.site.register(YandexUser)
@@ -1,5 +1,9 @@
-from update_db import update_all_db
+from . import scheduler
 
 
-def update_db():
-    print("Updating all")
+def discover_routes():
+    scheduler.discover_routes()
+
+
+def refresh_routes():
+    scheduler.refresh_due_routes()
@@ -0,0 +1,35 @@
+import hashlib
+import time
+from threading import Lock
+
+from django.conf import settings
+from django.db.models import Count, Max
+
+from .models import Bus
+
+
+def get_data_version():
+    data = Bus.objects.aggregate(refreshed_at=Max('refreshed_at'), count=Count('id'))
+    return hashlib.sha256(f"{data['refreshed_at']}-{data['count']}".encode()).hexdigest()[:16]
+
+
+class DataVersion:
+
+    def __init__(self, check_interval):
+        self.check_interval = check_interval
+        self._version = None
+        self._checked_at = None
+        self._lock = Lock()
+
+    def get(self):
+        with self._lock:
+            if self._checked_at is not None and time.monotonic() - self._checked_at < self.check_interval:
+                return self._version
+        version = get_data_version()
+        with self._lock:
+            self._version = version
+            self._checked_at = time.monotonic()
+        return version
+
+
+data_version = DataVersion(settings.DATA_VERSION_CHECK_SECONDS)
@@ -0,0 +1,127 @@
+import logging
+import os
+import time
+from array import array
+from bisect import bisect_left
+from datetime import datetime, timedelta
+from threading import Event, Lock, Thread
+
+from django.conf import settings
+from django.db import connection
+
+from .data_version import get_data_version
+from .models import DAY_TYPES, Bus, BusStop, Trip, TripException
+from .trips import get_bus_stop_times, get_day_type, load_trips
+
+logger = logging.getLogger(__name__)
+
+
+class DepartureIndex:
+
+    def __init__(self, check_interval):
+        self.check_interval = check_interval
+        self.version = None
+        self._refreshed_at_by_bus = {}
+        self._bus_stops_by_bus = {}
+        self._bus_stops = {}
+        self._lock = Lock()
+        self._loaded = Event()
+        self._pid = None
+
+    def get_version(self):
+        self._start()
+        self._loaded.wait()
+        return self.version
+
+    def get_departures(self, bus_stop_ids, limit):
+        now = datetime.now()
+        minute = now.hour * 60 + now.minute
+        day_type, next_day_type = get_day_type(now), get_day_type(now + timedelta(days=1))
+        # The reload swaps the whole dict, so one read gives a consistent index
+        index_bus_stops = self._bus_stops
+        bus_stops = []
+        for bus_stop_id in bus_stop_ids:
+            if bus_stop_id not in index_bus_stops:
+                continue
+            bus_stop, schedules = index_bus_stops[bus_stop_id]
+            index = bisect_left(schedules[day_type], minute)
+            departures = list(schedules[day_type][index:index + limit])
+            departures.extend(schedules[next_day_type][:limit - len(departures)])
+            bus_stops.append({**bus_stop, 'departures': [f"{x // 60 % 24:02d}:{x % 60:02d}" for x in departures]})
+        return bus_stops
+
+    def _start(self):
+        with self._lock:
+            # Threads do not survive a fork, so every worker process starts its own
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+        Thread(target=self._run, name='departure-index', daemon=True).start()
+
+    def _run(self):
+        while True:
+            try:
+                self._reload()
+            except Exception:
+                logger.exception("Failed to reload the departure index")
+            finally:
+                connection.close()
+                self._loaded.set()
+            time.sleep(self.check_interval)
+
+    def _reload(self):
+        version = get_data_version()
+        if version == self.version:
+            return
+        refreshed_at_by_bus = dict(Bus.objects.values_list('id', 'refreshed_at'))
+        changed_bus_ids = [
+            bus_id for bus_id, refreshed_at in refreshed_at_by_bus.items()
+            if bus_id not in self._refreshed_at_by_bus or self._refreshed_at_by_bus[bus_id] != refreshed_at
+        ]
+        bus_stops_by_bus = {
+            bus_id: bus_stops for bus_id, bus_stops in self._bus_stops_by_bus.items()
+            if bus_id in refreshed_at_by_bus and bus_id not in changed_bus_ids
+        }
+        # Only routes refreshed since the last load are read again, all of them the first time
+        bus_stops_by_bus.update(self._load_buses(changed_bus_ids if self.version is not None else None))
+        bus_stops = {}
+        for bus_stops_of_bus in bus_stops_by_bus.values():
+            bus_stops.update(bus_stops_of_bus)
+        with self._lock:
+            self._bus_stops_by_bus = bus_stops_by_bus
+            self._bus_stops = bus_stops
+            self._refreshed_at_by_bus = refreshed_at_by_bus
+            self.version = version
+
+    @staticmethod
+    def _load_buses(bus_ids):
+        trips = Trip.objects.all()
+        exceptions = TripException.objects.all()
+        bus_stops = BusStop.objects.all()
+        if bus_ids is not None:
+            trips = trips.filter(direction__bus_id__in=bus_ids)
+            exceptions = exceptions.filter(trip__direction__bus_id__in=bus_ids)
+            bus_stops = bus_stops.filter(direction__bus_id__in=bus_ids)
+        trips_by_direction_and_day_type = load_trips(trips, exceptions)
+        bus_stops = bus_stops.values_list(
+            'id', 'name', 'offsets', 'direction_id', 'direction__name', 'direction__bus_id', 'direction__bus__name',
+            'direction__bus__transport'
+        )
+        buses = {}
+        for bus_stop_id, name, offsets, direction_id, direction, bus_id, bus, transport in bus_stops.iterator():
+            # Minutes since midnight take two bytes each instead of a datetime object
+            schedules = {
+                day_type: array('h', get_bus_stop_times(
+                    trips_by_direction_and_day_type.get((direction_id, day_type), []), bus_stop_id,
+                    offsets.get(day_type, 0)
+                ))
+                for day_type, _ in DAY_TYPES
+            }
+            buses.setdefault(bus_id, {})[bus_stop_id] = (
+                {'id': bus_stop_id, 'name': name, 'direction': direction, 'bus': bus, 'transport': transport},
+                schedules,
+            )
+        return buses
+
+
+departure_index = DepartureIndex(settings.DATA_VERSION_CHECK_SECONDS)
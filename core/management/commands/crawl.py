@@ -0,0 +1,37 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from core.scheduler import refresh_lock
+from core.update_db import update_shards
+
+
+class Command(BaseCommand):
+    help = 'Crawls routes and timetables from kogda.by, one worker process per city and transport shard'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--shard', action='append', dest='shards', metavar='CITY/TRANSPORT',
+                            help='Shard to crawl, for example brest/autobus. Defaults to all CRAWL_SHARDS')
+        parser.add_argument('--processes', type=int, default=settings.CRAWL_PROCESSES)
+        parser.add_argument('--full', action='store_true', help='Download timetables of unchanged routes too')
+
+    def handle(self, *args, **options):
+        shards = settings.CRAWL_SHARDS
+        if options['shards']:
+            shards = [self._parse_shard(shard) for shard in options['shards']]
+        with refresh_lock() as is_locked:
+            if not is_locked:
+                raise CommandError('Another refresh is running')
+            results = update_shards(shards, options['processes'], options['full'])
+        for (city, transport), result in zip(shards, results):
+            if isinstance(result, Exception):
+                self.stderr.write(f'{city}/{transport}: {result}')
+            else:
+                self.stdout.write(f'{city}/{transport}: {result} s')
+        if any(isinstance(result, Exception) for result in results):
+            raise CommandError('Some shards were not published, run the command again to resume them')
+
+    @staticmethod
+    def _parse_shard(shard):
+        if shard.count('/') != 1:
+            raise CommandError(f'Invalid shard {shard}, expected CITY/TRANSPORT')
+        return tuple(shard.split('/'))
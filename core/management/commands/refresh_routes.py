@@ -0,0 +1,22 @@
+from django.core.management.base import BaseCommand
+
+from core.scheduler import discover_routes, refresh_due_routes, run_scheduler
+
+
+class Command(BaseCommand):
+    help = 'Refreshes the routes that are due, a small batch at a time'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, help='Defaults to REFRESH_BATCH_SIZE')
+        parser.add_argument('--discover', action='store_true', help='Look up added and removed routes first')
+        parser.add_argument('--loop', action='store_true',
+                            help='Keep running and refresh a batch every REFRESH_TICK_SECONDS')
+
+    def handle(self, *args, **options):
+        if options['loop']:
+            run_scheduler()
+        if options['discover']:
+            discover_routes()
+        buses = refresh_due_routes(options['batch_size'])
+        for bus in buses:
+            self.stdout.write(f'{bus.city}/{bus.transport}: {bus.name}')
@@ -0,0 +1,32 @@
+# Generated by Django 3.2.5 on 2026-10-19 15:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0002_change_detection'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='bus',
+            name='city',
+            field=models.CharField(default='brest', max_length=50),
+        ),
+        migrations.AddField(
+            model_name='bus',
+            name='transport',
+            field=models.CharField(choices=[('autobus', 'Autobus'), ('trolleybus', 'Trolleybus'), ('tram', 'Tram')], default='autobus', max_length=10),
+        ),
+        migrations.AddField(
+            model_name='yandexuser',
+            name='city',
+            field=models.CharField(default='brest', max_length=50),
+        ),
+        migrations.AddIndex(
+            model_name='bus',
+            index=models.Index(fields=['city', 'transport', 'name'], name='core_bus_city_d6e063_idx'),
+        ),
+    ]
@@ -0,0 +1,48 @@
+# Generated by Django 3.2.5 on 2026-10-19 16:30
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0003_city_and_transport'),
+    ]
+
+    operations = [
+        migrations.RemoveField(
+            model_name='busstop',
+            name='schedule',
+        ),
+        migrations.RemoveField(
+            model_name='busstop',
+            name='timetables',
+        ),
+        migrations.AddField(
+            model_name='busstop',
+            name='offsets',
+            field=models.JSONField(blank=True, default=dict),
+        ),
+        migrations.CreateModel(
+            name='Trip',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('day_type', models.CharField(choices=[('weekday', 'Weekday'), ('weekend', 'Weekend')], max_length=7)),
+                ('departure', models.IntegerField()),
+                ('direction', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='trips', to='core.direction')),
+            ],
+            options={
+                'ordering': ['departure'],
+            },
+        ),
+        migrations.CreateModel(
+            name='TripException',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('time', models.IntegerField(blank=True, null=True)),
+                ('bus_stop', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='trip_exceptions', to='core.busstop')),
+                ('trip', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='exceptions', to='core.trip')),
+            ],
+        ),
+    ]
@@ -0,0 +1,41 @@
+# Generated by Django 3.2.5 on 2026-10-19 17:20
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0004_trips'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CrawlRun',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('city', models.CharField(max_length=50)),
+                ('transport', models.CharField(choices=[('autobus', 'Autobus'), ('trolleybus', 'Trolleybus'), ('tram', 'Tram')], max_length=10)),
+                ('full', models.BooleanField(default=False)),
+                ('status', models.CharField(choices=[('running', 'Running'), ('failed', 'Failed'), ('published', 'Published'), ('abandoned', 'Abandoned')], default='running', max_length=9)),
+                ('bus_names', models.JSONField(blank=True, default=list)),
+                ('started_at', models.DateTimeField(auto_now_add=True)),
+                ('finished_at', models.DateTimeField(blank=True, null=True)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='CrawlUnit',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('bus_name', models.CharField(max_length=10)),
+                ('direction_name', models.CharField(blank=True, max_length=100)),
+                ('status', models.CharField(choices=[('pending', 'Pending'), ('done', 'Done'), ('failed', 'Failed')], default='pending', max_length=7)),
+                ('attempts', models.PositiveIntegerField(default=0)),
+                ('data', models.JSONField(blank=True, default=dict)),
+                ('error', models.TextField(blank=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('run', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='units', to='core.crawlrun')),
+            ],
+        ),
+    ]
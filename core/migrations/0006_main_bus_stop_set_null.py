@@ -0,0 +1,19 @@
+# Generated by Django 3.2.5 on 2026-10-20 10:00
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0005_crawl_runs'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='yandexuser',
+            name='main_bus_stop',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='core.busstop'),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 3.2.5 on 2026-10-20 11:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0006_main_bus_stop_set_null'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='bus',
+            name='refresh_failed_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='bus',
+            name='refresh_failures',
+            field=models.PositiveIntegerField(default=0),
+        ),
+    ]
@@ -0,0 +1,50 @@
+# Generated by Django 3.2.5 on 2026-10-21 10:00
+
+from django.db import migrations, models
+
+DAY_TYPE_TO_DAYS_OF_WEEK = {
+    'weekday': ['monday', 'tuesday', 'wednesday', 'thursday', 'friday'],
+    'weekend': ['saturday', 'sunday'],
+}
+
+
+def split_day_types(apps, schema_editor):
+    Trip = apps.get_model('core', 'Trip')
+    TripException = apps.get_model('core', 'TripException')
+    BusStop = apps.get_model('core', 'BusStop')
+    for day_type, days_of_week in DAY_TYPE_TO_DAYS_OF_WEEK.items():
+        for trip in Trip.objects.filter(day_type=day_type).prefetch_related('exceptions'):
+            for day_of_week in days_of_week[1:]:
+                copied_trip = Trip.objects.create(
+                    direction_id=trip.direction_id, day_type=day_of_week, departure=trip.departure
+                )
+                TripException.objects.bulk_create([
+                    TripException(trip=copied_trip, bus_stop_id=exception.bus_stop_id, time=exception.time)
+                    for exception in trip.exceptions.all()
+                ])
+        Trip.objects.filter(day_type=day_type).update(day_type=days_of_week[0])
+    for bus_stop in BusStop.objects.iterator():
+        for field in ('offsets', 'timetable_hashes'):
+            values = getattr(bus_stop, field)
+            setattr(bus_stop, field, {
+                day_of_week: values[day_type]
+                for day_type, days_of_week in DAY_TYPE_TO_DAYS_OF_WEEK.items() if day_type in values
+                for day_of_week in days_of_week
+            })
+        bus_stop.save(update_fields=['offsets', 'timetable_hashes'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0007_refresh_backoff'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='trip',
+            name='day_type',
+            field=models.CharField(choices=[('monday', 'Monday'), ('tuesday', 'Tuesday'), ('wednesday', 'Wednesday'), ('thursday', 'Thursday'), ('friday', 'Friday'), ('saturday', 'Saturday'), ('sunday', 'Sunday')], max_length=9),
+        ),
+        migrations.RunPython(split_day_types, migrations.RunPython.noop),
+    ]
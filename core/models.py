@@ -1,14 +1,55 @@
 from django.db import models
-from django.contrib.postgres.fields import ArrayField
 
 TIME_FORMATS = (
     ('time_interval', 'Time interval'),
     ('time', 'Time'),
 )
 
+# Timetables are kept for every day of the week, in the order of date.weekday()
+DAY_TYPES = (
+    ('monday', 'Monday'),
+    ('tuesday', 'Tuesday'),
+    ('wednesday', 'Wednesday'),
+    ('thursday', 'Thursday'),
+    ('friday', 'Friday'),
+    ('saturday', 'Saturday'),
+    ('sunday', 'Sunday'),
+)
+
+CRAWL_RUN_STATUSES = (
+    ('running', 'Running'),
+    ('failed', 'Failed'),
+    ('published', 'Published'),
+    ('abandoned', 'Abandoned'),
+)
+
+CRAWL_UNIT_STATUSES = (
+    ('pending', 'Pending'),
+    ('done', 'Done'),
+    ('failed', 'Failed'),
+)
+
+TRANSPORTS = (
+    ('autobus', 'Autobus'),
+    ('trolleybus', 'Trolleybus'),
+    ('tram', 'Tram'),
+)
+
 
 class Bus(models.Model):
     name = models.CharField(max_length=10)
+    city = models.CharField(max_length=50, default='brest')
+    transport = models.CharField(max_length=10, choices=TRANSPORTS, default='autobus')
+    page_hash = models.CharField(max_length=64, blank=True)
+    etag = models.CharField(max_length=200, blank=True)
+    last_modified = models.CharField(max_length=100, blank=True)
+    refreshed_at = models.DateTimeField(blank=True, null=True)
+    crawled_at = models.DateTimeField(blank=True, null=True)
+    refresh_failed_at = models.DateTimeField(blank=True, null=True)
+    refresh_failures = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        indexes = [models.Index(fields=['city', 'transport', 'name'])]
 
     def __str__(self):
         return self.name
@@ -26,13 +67,56 @@ class BusStop(models.Model):
     name = models.CharField(max_length=100)
     direction = models.ForeignKey('Direction', on_delete=models.CASCADE, related_name='bus_stops', blank=True,
                                   null=True)
-    schedule = ArrayField(models.DateTimeField(blank=True, null=True), blank=True, null=True)
+    position = models.PositiveIntegerField(default=0)
+    offsets = models.JSONField(default=dict, blank=True)
+    timetable_hashes = models.JSONField(default=dict, blank=True)
+
+    class Meta:
+        ordering = ['position', 'id']
 
     def __str__(self):
         return self.name
 
 
+class Trip(models.Model):
+    direction = models.ForeignKey('Direction', on_delete=models.CASCADE, related_name='trips')
+    day_type = models.CharField(max_length=9, choices=DAY_TYPES)
+    departure = models.IntegerField()
+
+    class Meta:
+        ordering = ['departure']
+
+
+class TripException(models.Model):
+    trip = models.ForeignKey('Trip', on_delete=models.CASCADE, related_name='exceptions')
+    bus_stop = models.ForeignKey('BusStop', on_delete=models.CASCADE, related_name='trip_exceptions')
+    time = models.IntegerField(blank=True, null=True)
+
+
+class CrawlRun(models.Model):
+    city = models.CharField(max_length=50)
+    transport = models.CharField(max_length=10, choices=TRANSPORTS)
+    full = models.BooleanField(default=False)
+    status = models.CharField(max_length=9, choices=CRAWL_RUN_STATUSES, default='running')
+    bus_names = models.JSONField(default=list, blank=True)
+    started_at = models.DateTimeField(auto_now_add=True)
+    finished_at = models.DateTimeField(blank=True, null=True)
+
+
+class CrawlUnit(models.Model):
+    run = models.ForeignKey('CrawlRun', on_delete=models.CASCADE, related_name='units')
+    bus_name = models.CharField(max_length=10)
+    # Empty for the unit that downloads the route page, otherwise the direction whose timetables are downloaded
+    direction_name = models.CharField(max_length=100, blank=True)
+    status = models.CharField(max_length=7, choices=CRAWL_UNIT_STATUSES, default='pending')
+    attempts = models.PositiveIntegerField(default=0)
+    data = models.JSONField(default=dict, blank=True)
+    error = models.TextField(blank=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+
 class YandexUser(models.Model):
     yandex_id = models.CharField(max_length=100)
-    main_bus_stop = models.ForeignKey('BusStop', on_delete=models.CASCADE, related_name='+', blank=True, null=True)
+    main_bus_stop = models.ForeignKey('BusStop', on_delete=models.SET_NULL, related_name='+', blank=True, null=True)
     time_format = models.CharField(max_length=13, choices=TIME_FORMATS, default='time_interval')
+    city = models.CharField(max_length=50, default='brest')
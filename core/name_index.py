@@ -0,0 +1,36 @@
+from threading import Lock
+
+from .data_version import data_version
+from .models import Bus, BusStop
+
+
+class NameIndex:
+
+    def __init__(self):
+        self._names = {}
+        self._lock = Lock()
+
+    def get_bus_names(self, city, transport):
+        return self._get_names(("bus", city, transport), lambda: list(
+            Bus.objects.filter(city=city, transport=transport).values_list("name", flat=True).distinct()
+        ))
+
+    def get_bus_stop_names(self, city, transport):
+        return self._get_names(("bus stop", city, transport), lambda: list(
+            BusStop.objects.filter(direction__bus__city=city, direction__bus__transport=transport)
+            .values_list("name", flat=True).distinct()
+        ))
+
+    def _get_names(self, key, load_names):
+        version = data_version.get()
+        with self._lock:
+            loaded_version, names = self._names.get(key, (None, None))
+        if loaded_version == version:
+            return names
+        names = load_names()
+        with self._lock:
+            self._names[key] = (version, names)
+        return names
+
+
+name_index = NameIndex()
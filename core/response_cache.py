@@ -0,0 +1,29 @@
+from collections import OrderedDict
+from threading import Lock
+
+MAX_SIZE = 1024
+
+
+class ResponseCache:
+
+    def __init__(self, max_size=MAX_SIZE):
+        self.max_size = max_size
+        self._items = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, key):
+        with self._lock:
+            if key not in self._items:
+                return None
+            self._items.move_to_end(key)
+            return self._items[key]
+
+    def set(self, key, value):
+        with self._lock:
+            self._items[key] = value
+            self._items.move_to_end(key)
+            while len(self._items) > self.max_size:
+                self._items.popitem(last=False)
+
+
+response_cache = ResponseCache()
@@ -0,0 +1,120 @@
+import asyncio
+import logging
+import time
+from contextlib import asynccontextmanager, contextmanager
+from datetime import timedelta
+
+import aiohttp
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, connections
+from django.db.models import DurationField, Exists, ExpressionWrapper, F, OuterRef, Q
+from django.db.models.functions import Least, Power
+from django.utils import timezone
+
+from .models import Bus, YandexUser
+from .update_db import refresh_bus, update_buses
+
+logger = logging.getLogger(__name__)
+
+REFRESH_LOCK_ID = 7301
+
+
+class RateLimitedSession:
+
+    def __init__(self, session, requests_per_second):
+        self.session = session
+        self.interval = 1 / requests_per_second
+        self._next_request_at = 0
+
+    @asynccontextmanager
+    async def get(self, *args, **kwargs):
+        now = time.monotonic()
+        wait_time = self._next_request_at - now
+        self._next_request_at = max(now, self._next_request_at) + self.interval
+        if wait_time > 0:
+            await asyncio.sleep(wait_time)
+        async with self.session.get(*args, **kwargs) as response:
+            yield response
+
+
+@contextmanager
+def refresh_lock():
+    # The lock lives on a connection of its own: the crawl closes all of Django's connections before forking workers,
+    # which would silently release a lock held on the default one
+    lock_connection = connections.create_connection(DEFAULT_DB_ALIAS)
+    try:
+        with lock_connection.cursor() as cursor:
+            cursor.execute("SELECT pg_try_advisory_lock(%s)", [REFRESH_LOCK_ID])
+            is_locked = cursor.fetchone()[0]
+        yield is_locked
+    finally:
+        # Ending the session releases the lock
+        lock_connection.close()
+
+
+def get_due_buses(batch_size):
+    now = timezone.now()
+    is_used = Exists(YandexUser.objects.filter(main_bus_stop__direction__bus=OuterRef('pk')))
+    is_due = (
+        Q(refreshed_at__isnull=True)
+        | Q(refreshed_at__lt=now - timedelta(hours=settings.REFRESH_INTERVAL_HOURS))
+        | Q(is_used=True, refreshed_at__lt=now - timedelta(hours=settings.PRIORITY_REFRESH_INTERVAL_HOURS))
+    )
+    # Failing routes are retried after exponentially growing delays so that they do not hold up the rest
+    retry_delay = ExpressionWrapper(
+        timedelta(minutes=settings.REFRESH_RETRY_MINUTES) * Power(2, Least(F('refresh_failures') - 1, 10)),
+        output_field=DurationField(),
+    )
+    buses = Bus.objects.annotate(is_used=is_used).filter(is_due).exclude(refresh_failed_at__gt=now - retry_delay)
+    return list(buses.order_by('-is_used', F('refreshed_at').asc(nulls_first=True))[:batch_size])
+
+
+async def refresh_buses(buses):
+    async with aiohttp.ClientSession() as session:
+        session = RateLimitedSession(session, settings.REFRESH_REQUESTS_PER_SECOND)
+        results = await asyncio.gather(*(refresh_bus(bus, session) for bus in buses), return_exceptions=True)
+    for bus, result in zip(buses, results):
+        if isinstance(result, Exception):
+            logger.error("Failed to refresh %s %s in %s", bus.transport, bus.name, bus.city, exc_info=result)
+            await sync_to_async(_record_refresh_failure)(bus)
+
+
+def _record_refresh_failure(bus):
+    Bus.objects.filter(id=bus.id).update(refresh_failed_at=timezone.now(), refresh_failures=F('refresh_failures') + 1)
+
+
+async def discover_buses(shards):
+    async with aiohttp.ClientSession() as session:
+        session = RateLimitedSession(session, settings.REFRESH_REQUESTS_PER_SECOND)
+        for city, transport in shards:
+            await update_buses(city, transport, session)
+
+
+def refresh_due_routes(batch_size=None):
+    with refresh_lock() as is_locked:
+        if not is_locked:
+            logger.info("Skipping refresh, another refresh is running")
+            return []
+        buses = get_due_buses(batch_size or settings.REFRESH_BATCH_SIZE)
+        asyncio.run(refresh_buses(buses))
+        return buses
+
+
+def discover_routes():
+    with refresh_lock() as is_locked:
+        if not is_locked:
+            logger.info("Skipping route discovery, another refresh is running")
+            return False
+        asyncio.run(discover_buses(settings.CRAWL_SHARDS))
+        return True
+
+
+def run_scheduler():
+    discovered_at = None
+    while True:
+        if discovered_at is None or time.monotonic() - discovered_at >= timedelta(days=1).total_seconds():
+            if discover_routes():
+                discovered_at = time.monotonic()
+        refresh_due_routes()
+        time.sleep(settings.REFRESH_TICK_SECONDS)
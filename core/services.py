@@ -1,26 +1,76 @@
 import math
+import time
 from datetime import datetime, timedelta
 
-import requests
+from django.conf import settings
 from rest_framework.response import Response
 from fuzzywuzzy import process
 import humanize
 
-from .models import Bus, BusStop, YandexUser, Direction
+from .models import BusStop, YandexUser, Direction
+from .data_version import data_version
 from .dict2object import dict2object, Object
+from .name_index import name_index
+from .response_cache import ResponseCache, response_cache
+from .upstream import TimetableClient
 from .validate import validate
 
+humanize.i18n.activate("ru_RU")
+
+# Resolved commands by the words they were said with, so that a repeated phrase skips fuzzy matching of names
+command_cache = ResponseCache()
+
+CACHED_COMMAND_TYPES = ("get main bus schedule", "get bus schedule", "get bus schedules")
+
+TRANSPORT_TO_WORDS = {
+    "autobus": ["автобус", "автобуса"],
+    "trolleybus": ["троллейбус", "троллейбуса"],
+    "tram": ["трамвай", "трамвая"],
+}
+
+TRANSPORT_TO_PLURAL_WORD = {
+    "autobus": "автобусов",
+    "trolleybus": "троллейбусов",
+    "tram": "трамваев",
+}
+
+TRANSPORT_TO_NAME = {
+    "autobus": "Автобус",
+    "trolleybus": "Троллейбус",
+    "tram": "Трамвай",
+}
+
+CITY_TO_WORDS = {
+    "brest": ["брест", "бресте", "бреста"],
+    "minsk": ["минск", "минске", "минска"],
+    "grodno": ["гродно"],
+    "gomel": ["гомель", "гомеле", "гомеля"],
+    "vitebsk": ["витебск", "витебске", "витебска"],
+    "mogilev": ["могилев", "могилеве", "могилева", "могилёв", "могилёве", "могилёва"],
+}
+
 
 class Command:
 
-    def __init__(self, words_from_command):
+    def __init__(self, words_from_command, city):
         self.words_from_command = words_from_command
+        self.city = city
+        self.transport = self._determine_transport()
         self.type = self._determine_type_of_command()
+        self.city_from_command = self._get_city_from_command()
         self.bus_name = self._get_bus_name()
         self.guiding_bus_stop_name = self._get_guiding_bus_stop_name()
         self.bus_stop_name = self._get_bus_stop_name()
 
+    def _determine_transport(self):
+        for transport, words in TRANSPORT_TO_WORDS.items():
+            if any(word in self.words_from_command for word in words + [TRANSPORT_TO_PLURAL_WORD[transport]]):
+                return transport
+        return "autobus"
+
     def _determine_type_of_command(self):
+        if self._is_command_for_remember_city():
+            return "remember city"
         if self._is_command_for_remember_main_bus_schedule():
             return "remember main bus schedule"
         if self._is_command_for_get_main_bus_schedule():
@@ -32,22 +82,33 @@ class Command:
         return "unknown command"
 
     def _is_command_for_get_bus_schedules(self):
-        if "автобусов" in self.words_from_command:
+        if TRANSPORT_TO_PLURAL_WORD[self.transport] in self.words_from_command:
             return True
         return False
 
     def _is_command_for_get_bus_schedule(self):
-        if "автобус" in self.words_from_command or "автобуса" in self.words_from_command:
+        if any(word in self.words_from_command for word in TRANSPORT_TO_WORDS[self.transport]):
             return True
         return False
 
     def _is_command_for_get_main_bus_schedule(self):
-        if self.words_from_command and (self.words_from_command[0] in ['автобус', 'автобуса']
+        if self.words_from_command and (self.words_from_command[0] in TRANSPORT_TO_WORDS[self.transport]
                                         or 'мой' in self.words_from_command
                                         or self.words_from_command == ['во', 'сколько', 'будет', 'автобус']):
             return True
         return False
 
+    def _is_command_for_remember_city(self):
+        if "город" in self.words_from_command:
+            return True
+        return False
+
+    def _get_city_from_command(self):
+        crawled_cities = {city for city, transport in settings.CRAWL_SHARDS}
+        for city, words in CITY_TO_WORDS.items():
+            if city in crawled_cities and any(word in self.words_from_command for word in words):
+                return city
+
     def _is_command_for_remember_main_bus_schedule(self):
         if "запомни" in self.words_from_command:
             return True
@@ -56,8 +117,9 @@ class Command:
     def _get_bus_name(self):
         fuzzy_bus_name = self._get_fuzzy_bus_name()
         if fuzzy_bus_name:
-            all_bus_names = list(Bus.objects.values_list("name", flat=True).distinct())
-            return process.extractOne(fuzzy_bus_name, all_bus_names)[0]
+            all_bus_names = name_index.get_bus_names(self.city, self.transport)
+            if all_bus_names:
+                return process.extractOne(fuzzy_bus_name, all_bus_names)[0]
 
     def _get_fuzzy_bus_name(self):
         for index, word in enumerate(self.words_from_command):
@@ -70,8 +132,9 @@ class Command:
     def _get_guiding_bus_stop_name(self):
         fuzzy_guiding_bus_stop_name = self._get_fuzzy_guiding_bus_stop_name()
         if fuzzy_guiding_bus_stop_name:
-            all_bus_stop_names = list(BusStop.objects.values_list("name", flat=True).distinct())
-            return process.extractOne(fuzzy_guiding_bus_stop_name, all_bus_stop_names)[0]
+            all_bus_stop_names = name_index.get_bus_stop_names(self.city, self.transport)
+            if all_bus_stop_names:
+                return process.extractOne(fuzzy_guiding_bus_stop_name, all_bus_stop_names)[0]
 
     def _get_fuzzy_guiding_bus_stop_name(self):
         for index, word in enumerate(self.words_from_command):
@@ -81,8 +144,9 @@ class Command:
     def _get_bus_stop_name(self):
         fuzzy_bus_stop_name = self._get_fuzzy_bus_stop_name()
         if fuzzy_bus_stop_name:
-            all_bus_stop_names = list(BusStop.objects.values_list("name", flat=True).distinct())
-            return process.extractOne(fuzzy_bus_stop_name, all_bus_stop_names)[0]
+            all_bus_stop_names = name_index.get_bus_stop_names(self.city, self.transport)
+            if all_bus_stop_names:
+                return process.extractOne(fuzzy_bus_stop_name, all_bus_stop_names)[0]
 
     def _get_fuzzy_bus_stop_name(self):
         if "на" in self.words_from_command and "сторону" in self.words_from_command:
@@ -97,14 +161,27 @@ class Skill:
     yandex_user: YandexUser
 
     def __init__(self, request):
+        upstream_time_budget = settings.ALICE_RESPONSE_TIMEOUT - settings.UPSTREAM_RESERVED_TIME
+        self.timetable_client = TimetableClient(deadline=time.monotonic() + upstream_time_budget)
         self.data = dict2object(request.data)
         self.yandex_user = self._get_yandex_user_from_request()
-        self.main_bus_stop = self.yandex_user.main_bus_stop
-        command = Command(self.data.request.nlu.tokens)
+        self.main_bus_stop = self.yandex_user.main_bus_stop if self.yandex_user else None
+        self.city = self.yandex_user.city if self.yandex_user else settings.DEFAULT_CITY
+        command = self._get_command(self.data.request.nlu.tokens)
+        self.transport = command.transport
         self.command_type = command.type
         self.bus_name = command.bus_name
         self.bus_stop_name = command.bus_stop_name
         self.guiding_bus_stop_name = command.guiding_bus_stop_name
+        self.city_from_command = command.city_from_command
+
+    def _get_command(self, words_from_command):
+        key = (data_version.get(), self.city, tuple(words_from_command))
+        command = command_cache.get(key)
+        if command is None:
+            command = Command(words_from_command, self.city)
+            command_cache.set(key, command)
+        return command
 
     def _get_yandex_user_from_request(self):
         if hasattr(self.data.session, 'user'):
@@ -124,13 +201,35 @@ class Skill:
 
     def _get_response_text(self):
         command_type_to_method_for_getting_response_text = {
+            "remember city": self._remember_city,
             "remember main bus schedule": self._remember_main_bus_schedule,
             "get main bus schedule": self._get_main_bus_schedule,
             "get bus schedule": self._get_bus_schedule,
             "get bus schedules": self._get_bus_schedules,
             "unknown command": self._get_text_when_no_command,
         }
-        return command_type_to_method_for_getting_response_text[self.command_type]()
+        method_for_getting_response_text = command_type_to_method_for_getting_response_text[self.command_type]
+        if self.command_type not in CACHED_COMMAND_TYPES:
+            return method_for_getting_response_text()
+        key = self._get_response_cache_key()
+        text = response_cache.get(key)
+        if text is None:
+            text = method_for_getting_response_text()
+            response_cache.set(key, text)
+        return text
+
+    def _get_response_cache_key(self):
+        main_bus_stop_id = self.main_bus_stop.id if self.main_bus_stop else None
+        time_format = self.yandex_user.time_format if self.yandex_user else None
+        current_minute = datetime.now().strftime("%Y-%m-%d %H:%M")
+        return (data_version.get(), self.command_type, self.city, self.transport, self.bus_name, self.bus_stop_name,
+                self.guiding_bus_stop_name, main_bus_stop_id, time_format, current_minute)
+
+    @validate('yandex_user', 'city_from_command')
+    def _remember_city(self):
+        self.yandex_user.city = self.city_from_command
+        self.yandex_user.save()
+        return 'Я запомнила ваш город, теперь я буду искать автобусы в нём'
 
     @validate('yandex_user', 'bus_name', 'bus_stop_name', 'guiding_bus_stop_name')
     def _remember_main_bus_schedule(self):
@@ -158,14 +257,19 @@ class Skill:
     def _get_bus_stop_from_command(self):
         directions = self._get_directions_from_command()
         return BusStop.objects.filter(name=self.bus_stop_name, direction__in=directions,
-                                      direction__bus__name=self.bus_name).first()
+                                      direction__bus__name=self.bus_name).select_related('direction__bus').first()
 
     def _get_bus_stops_from_command(self):
         directions = self._get_directions_from_command()
-        return BusStop.objects.filter(name=self.bus_stop_name, direction__in=directions)
+        bus_stops = BusStop.objects.filter(name=self.bus_stop_name, direction__in=directions)
+        return bus_stops.select_related('direction__bus')
 
     def _get_directions_from_command(self):
-        directions_with_specified_bus_stops = Direction.objects.filter(bus_stops__name=self.bus_stop_name)
+        directions_with_specified_bus_stops = Direction.objects.filter(
+            bus_stops__name=self.bus_stop_name,
+            bus__city=self.city,
+            bus__transport=self.transport,
+        )
         directions_from_bus_stop_to_guiding_bus_stop = self._filter_directions_by_bus_stop(
             directions=directions_with_specified_bus_stops,
             first_bus_stop_name=self.bus_stop_name,
@@ -224,12 +328,14 @@ class Skill:
         if not self.yandex_user or self.yandex_user.time_format == 'time':
             nearest_time, next_time = self._get_current_bus_times(bus_stop)
             bus_name = bus_stop.direction.bus.name
-            return f'Автобус номер {bus_name} будет в {nearest_time}, а следующий в {next_time}'
+            transport_name = TRANSPORT_TO_NAME[bus_stop.direction.bus.transport]
+            return f'{transport_name} номер {bus_name} будет в {nearest_time}, а следующий в {next_time}'
         nearest_time_interval, next_time_interval = self._get_current_bus_time_interval(bus_stop)
         bus_name = bus_stop.direction.bus.name
+        transport_name = TRANSPORT_TO_NAME[bus_stop.direction.bus.transport]
         if nearest_time_interval and next_time_interval:
-            return f'Автобус номер {bus_name} будет через {nearest_time_interval}, а следующий через ' \
-                   f'{next_time_interval}'
+            return f'{transport_name} номер {bus_name} будет через {nearest_time_interval}, ' \
+                   f'а следующий через {next_time_interval}'
         return ""
 
     def _get_current_bus_time_interval(self, bus_stop):
@@ -239,7 +345,6 @@ class Skill:
         ]
         if len(current_bus_times) >= 2:
             now = datetime.now()
-            humanize.i18n.activate("ru_RU")
             return [humanize.naturaldelta(x - now) for x in current_bus_times[:2]]
         return False, False
 
@@ -251,41 +356,12 @@ class Skill:
         return (x.strftime("%H %M") if x.hour > 9 else x.strftime("%H %M")[1:] for x in current_bus_times[:2])
 
     def _get_schedules_for_today_and_tomorrow(self, bus_stop):
-        schedules_for_today = self._get_schedules_for_today(bus_stop)
-        schedules_for_tomorrow = self._get_schedules_for_tomorrow(bus_stop)
+        today = datetime.now()
+        schedules_for_today, schedules_for_tomorrow = self.timetable_client.get_schedules(
+            bus_stop, [today, today + timedelta(days=1)]
+        )
         return schedules_for_today + schedules_for_tomorrow
 
-    @staticmethod
-    def _get_schedules_for_today(bus_stop):
-        date_string = datetime.now().strftime("%Y-%m-%d")
-        params = {
-            "city": "brest",
-            "transport": "autobus",
-            "route": bus_stop.direction.bus.name,
-            "direction": bus_stop.direction.name,
-            "busStop": bus_stop.name,
-            "date": date_string,
-        }
-        response = requests.get("https://kogda.by/api/getTimetable", params, headers={'User-Agent': 'Mozilla/5.0'})
-        timetable = response.json()["timetable"]
-        return [datetime.strptime(x + " " + date_string, "%H:%M %Y-%m-%d") for x in timetable]
-
-    @staticmethod
-    def _get_schedules_for_tomorrow(bus_stop):
-        date_for_tomorrow = datetime.now() + timedelta(days=1)
-        date_string = date_for_tomorrow.strftime("%Y-%m-%d")
-        params = {
-            "city": "brest",
-            "transport": "autobus",
-            "route": bus_stop.direction.bus.name,
-            "direction": bus_stop.direction.name,
-            "busStop": bus_stop.name,
-            "date": date_string,
-        }
-        response = requests.get("https://kogda.by/api/getTimetable", params, headers={'User-Agent': 'Mozilla/5.0'})
-        timetable = response.json()["timetable"]
-        return [datetime.strptime(x + " " + date_string, "%H:%M %Y-%m-%d") for x in timetable]
-
     @staticmethod
     def _is_current_bus_time(bus_time):
         delta = bus_time - datetime.now()
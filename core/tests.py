@@ -1,3 +1,363 @@
-from django.test import TestCase
+import random
+import time
+from contextlib import asynccontextmanager
+from datetime import datetime, timedelta
+from threading import Lock
+from unittest import mock
 
-# Create your tests here.
+import requests
+from asgiref.sync import async_to_sync
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.utils import timezone
+from rest_framework.test import APIRequestFactory
+
+from .models import Bus, CrawlRun, CrawlUnit, Trip
+from .trips import derive_trips, get_bus_stop_times, text_time_to_minutes
+from .update_db import TIMETABLE_URL, _get_crawl_run, _reset_stale_units, crawl_shard
+from .upstream import CircuitBreaker, DeadlineExceeded, TimetableClient, UpstreamError
+from .views import DeparturesView
+
+
+class DeriveTripsTest(SimpleTestCase):
+
+    def assert_round_trip(self, timetables):
+        offsets, trips = derive_trips(timetables)
+        trips = [(trip['departure'], trip['exceptions']) for trip in trips]
+        self.assertEqual(len(offsets), len(timetables))
+        for index, timetable in enumerate(timetables):
+            self.assertEqual(
+                get_bus_stop_times(trips, index, offsets[index]), sorted(text_time_to_minutes(x) for x in timetable)
+            )
+        return offsets, trips
+
+    def test_regular_trips_have_no_exceptions(self):
+        timetables = [
+            ["06:00", "06:30", "07:00"],
+            ["06:05", "06:35", "07:05"],
+            ["06:12", "06:42", "07:12"],
+        ]
+        offsets, trips = self.assert_round_trip(timetables)
+        self.assertEqual(offsets, [0, 5, 12])
+        self.assertEqual(trips, [(360, {}), (390, {}), (420, {})])
+
+    def test_midnight_wrap(self):
+        self.assert_round_trip([
+            ["00:05", "23:30", "23:55"],
+            ["00:10", "23:35", "00:00"],
+            ["00:17", "23:42", "00:07"],
+        ])
+
+    def test_duplicate_times(self):
+        self.assert_round_trip([
+            ["08:00", "08:00", "08:20"],
+            ["08:04", "08:04", "08:24"],
+            ["08:09", "08:10", "08:29", "08:29"],
+        ])
+
+    def test_empty_bus_stops(self):
+        self.assertEqual(derive_trips([]), ([], []))
+        self.assert_round_trip([[], [], []])
+        self.assert_round_trip([["07:00", "07:30"], [], ["07:10", "07:40"]])
+        self.assert_round_trip([[], ["07:00", "07:30"], ["07:10", "07:40"]])
+
+    def test_trips_starting_mid_route(self):
+        offsets, trips = self.assert_round_trip([
+            ["06:00", "07:00"],
+            ["06:05", "06:35", "07:05"],
+            ["06:10", "06:40", "07:10", "07:25"],
+        ])
+        self.assertEqual(len(trips), 4)
+
+    def test_periodic_trips_wrapping_at_midnight_keep_moving_forward(self):
+        departures = range(0, 24 * 60, 15)
+        offsets, trips = self.assert_round_trip([
+            [f"{(x + offset) // 60 % 24:02d}:{(x + offset) % 60:02d}" for x in departures] for offset in (0, 7, 15)
+        ])
+        self.assertEqual(offsets, [0, 7, 15])
+        for departure, exceptions in trips:
+            times = [exceptions.get(index, departure + offset) for index, offset in enumerate(offsets)]
+            times = [time for time in times if time is not None]
+            self.assertEqual(times, sorted(times))
+
+    def test_random_timetables(self):
+        generator = random.Random(0)
+        for _ in range(50):
+            departures = sorted(generator.randrange(5 * 60, 24 * 60) for _ in range(generator.randrange(1, 40)))
+            timetables = []
+            time_from_start = 0
+            for _ in range(generator.randrange(1, 20)):
+                time_from_start += generator.randrange(1, 6)
+                times = [
+                    x + time_from_start + generator.randrange(-2, 3) for x in departures if generator.random() > 0.1
+                ]
+                timetables.append([f"{x // 60 % 24:02d}:{x % 60:02d}" for x in times])
+            self.assert_round_trip(timetables)
+
+
+class CircuitBreakerTest(SimpleTestCase):
+
+    def test_opens_after_threshold_failures_in_a_row(self):
+        breaker = CircuitBreaker(failure_threshold=2, recovery_timeout=30)
+        breaker.record_failure()
+        breaker.record_success()
+        breaker.record_failure()
+        self.assertFalse(breaker.is_open())
+        self.assertTrue(breaker.has_recent_failures())
+        breaker.record_failure()
+        self.assertTrue(breaker.is_open())
+
+    def test_half_open_lets_a_single_trial_through(self):
+        breaker = CircuitBreaker(failure_threshold=1, recovery_timeout=30)
+        with mock.patch('core.upstream.time.monotonic', return_value=100):
+            breaker.record_failure()
+        with mock.patch('core.upstream.time.monotonic', return_value=129):
+            self.assertTrue(breaker.is_open())
+        with mock.patch('core.upstream.time.monotonic', return_value=131):
+            self.assertFalse(breaker.is_open())
+            self.assertTrue(breaker.is_open())
+            breaker.record_failure()
+        with mock.patch('core.upstream.time.monotonic', return_value=160):
+            self.assertTrue(breaker.is_open())
+        with mock.patch('core.upstream.time.monotonic', return_value=162):
+            self.assertFalse(breaker.is_open())
+            breaker.record_success()
+            self.assertFalse(breaker.is_open())
+            self.assertFalse(breaker.has_recent_failures())
+
+
+@override_settings(UPSTREAM_HEDGE_DELAY=0.05, UPSTREAM_MAX_ATTEMPTS=3)
+class HedgedTimetableTest(SimpleTestCase):
+
+    def setUp(self):
+        self.breaker = CircuitBreaker(failure_threshold=5, recovery_timeout=30)
+        patcher = mock.patch('core.upstream.circuit_breaker', self.breaker)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.requests = 0
+        self.lock = Lock()
+
+    def get_timetable(self, budget, durations, error=None):
+        def request_timetable(client, params):
+            with self.lock:
+                attempt = self.requests
+                self.requests += 1
+            time.sleep(durations[min(attempt, len(durations) - 1)])
+            if error is not None:
+                raise error
+            return ["06:00"]
+
+        with mock.patch.object(TimetableClient, '_request_timetable', request_timetable):
+            return TimetableClient(deadline=time.monotonic() + budget)._get_timetable({})
+
+    def test_fast_response_is_not_hedged(self):
+        self.assertEqual(self.get_timetable(1, [0]), ["06:00"])
+        self.assertEqual(self.requests, 1)
+        self.assertFalse(self.breaker.has_recent_failures())
+
+    def test_slow_response_is_hedged(self):
+        self.assertEqual(self.get_timetable(1, [0.5, 0]), ["06:00"])
+        self.assertEqual(self.requests, 2)
+
+    def test_no_hedging_after_recent_failures(self):
+        self.breaker.record_failure()
+        self.assertEqual(self.get_timetable(1, [0.2, 0]), ["06:00"])
+        self.assertEqual(self.requests, 1)
+        self.assertFalse(self.breaker.has_recent_failures())
+
+    def test_no_budget_sends_nothing_and_counts_nothing(self):
+        with self.assertRaises(DeadlineExceeded):
+            self.get_timetable(-1, [0])
+        self.assertEqual(self.requests, 0)
+        self.assertFalse(self.breaker.has_recent_failures())
+
+    def test_leftover_budget_timeout_is_not_counted(self):
+        with self.assertRaises(UpstreamError):
+            self.get_timetable(0.03, [0.2])
+        self.assertFalse(self.breaker.has_recent_failures())
+
+    def test_timeout_with_real_budget_is_counted_once(self):
+        with self.assertRaises(UpstreamError):
+            self.get_timetable(0.2, [0.5])
+        self.assertEqual(self.requests, 3)
+        self.assertEqual(self.breaker._failures, 1)
+
+    def test_errors_are_counted(self):
+        with self.assertRaises(UpstreamError):
+            self.get_timetable(1, [0], error=requests.ConnectionError())
+        self.assertEqual(self.requests, 3)
+        self.assertEqual(self.breaker._failures, 1)
+
+
+@override_settings(DEPARTURES_MAX_STOPS=3)
+class DeparturesViewTest(SimpleTestCase):
+
+    def setUp(self):
+        self.factory = APIRequestFactory()
+        self.view = DeparturesView.as_view()
+        self.index = mock.Mock()
+        self.index.get_version.return_value = 'v1'
+        self.index.get_departures.return_value = [{'id': 1, 'departures': ['06:00']}]
+        self.now = mock.Mock()
+        self.now.now.return_value = datetime(2026, 10, 19, 6, 0, 15)
+        for name, value in (('departure_index', self.index), ('datetime', self.now)):
+            patcher = mock.patch(f'core.views.{name}', value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_invalid_requests_are_rejected(self):
+        invalid_requests = [
+            self.factory.get('/departures'),
+            self.factory.get('/departures?stops=1,a'),
+            self.factory.get('/departures?stops=1&limit=a'),
+            self.factory.get('/departures?stops=1,2,3,4'),
+            self.factory.post('/departures', [1, 2], format='json'),
+            self.factory.post('/departures', {'stops': '1'}, format='json'),
+        ]
+        for request in invalid_requests:
+            self.assertEqual(self.view(request).status_code, 400)
+        self.index.get_departures.assert_not_called()
+
+    def test_departures_are_returned_with_etag(self):
+        response = self.view(self.factory.post('/departures', {'stops': [1], 'limit': 100}, format='json'))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data, {'version': 'v1', 'stops': [{'id': 1, 'departures': ['06:00']}]})
+        self.assertEqual(response['ETag'], '"v1-202610190600"')
+        self.assertEqual(response['Cache-Control'], 'public, max-age=45')
+        self.index.get_departures.assert_called_once_with([1], 20)
+
+    def test_matching_etag_is_not_modified(self):
+        request = self.factory.get('/departures?stops=1', HTTP_IF_NONE_MATCH='"v1-202610190600"')
+        response = self.view(request)
+        self.assertEqual(response.status_code, 304)
+        self.index.get_departures.assert_not_called()
+
+    def test_new_version_or_minute_is_modified(self):
+        for etag in ('"v0-202610190600"', '"v1-202610190559"'):
+            response = self.view(self.factory.get('/departures?stops=1', HTTP_IF_NONE_MATCH=etag))
+            self.assertEqual(response.status_code, 200)
+
+
+class FakeResponse:
+
+    def __init__(self, status=200, text='', json=None):
+        self.status = status
+        self.headers = {}
+        self._text = text
+        self._json = json
+
+    def raise_for_status(self):
+        if self.status >= 400:
+            raise RuntimeError(f"HTTP {self.status}")
+
+    async def text(self):
+        return self._text
+
+    async def json(self):
+        return self._json
+
+
+class FakeSession:
+    ROUTES_PAGE = '<a class="btn btn-primary bold route">1</a>'
+    ROUTE_PAGE = (
+        '<a data-parent="#directions" href="#direction">Вокзал - Рынок</a>'
+        '<div id="direction"><ul><li><a>Вокзал</a></li><li><a>Рынок</a></li></ul></div>'
+    )
+    TIMETABLES = {"Вокзал": ["06:00", "07:00"], "Рынок": ["06:10", "07:10"]}
+
+    def __init__(self):
+        self.failing_bus_stop = None
+        self.urls = []
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        pass
+
+    @asynccontextmanager
+    async def get(self, url, params=None, headers=None):
+        self.urls.append(url)
+        if url != TIMETABLE_URL:
+            yield FakeResponse(text=self.ROUTE_PAGE if url.endswith('/1/') else self.ROUTES_PAGE)
+        elif params["busStop"] == self.failing_bus_stop:
+            yield FakeResponse(status=500)
+        else:
+            yield FakeResponse(json={"timetable": self.TIMETABLES[params["busStop"]]})
+
+
+class CrawlShardTest(TestCase):
+
+    def setUp(self):
+        self.session = FakeSession()
+        patcher = mock.patch('core.update_db.aiohttp.ClientSession', return_value=self.session)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_failed_run_is_resumed_and_published(self):
+        self.session.failing_bus_stop = "Рынок"
+        with self.assertRaises(RuntimeError), self.assertLogs('core.update_db') as logs:
+            async_to_sync(crawl_shard)('brest', 'autobus')
+        self.assertIn("Crawl of 1 Вокзал - Рынок failed", logs.output[0])
+        crawl_run = CrawlRun.objects.get()
+        self.assertEqual(crawl_run.status, 'failed')
+        self.assertEqual(set(crawl_run.units.values_list('direction_name', 'status')), {
+            ('', 'done'), ('Вокзал - Рынок', 'failed'),
+        })
+        self.assertFalse(Bus.objects.exists())
+        route_requests = self.session.urls.count(self.session.urls[1])
+
+        self.session.failing_bus_stop = None
+        async_to_sync(crawl_shard)('brest', 'autobus')
+        crawl_run.refresh_from_db()
+        self.assertEqual(crawl_run.status, 'published')
+        self.assertEqual(CrawlRun.objects.count(), 1)
+        self.assertFalse(crawl_run.units.exists())
+        self.assertEqual(self.session.urls.count(self.session.urls[1]), route_requests)
+        bus = Bus.objects.get()
+        self.assertIsNotNone(bus.refreshed_at)
+        self.assertEqual(list(bus.directions.get().bus_stops.values_list('name', flat=True)), ["Вокзал", "Рынок"])
+        self.assertEqual(Trip.objects.count(), 2 * 7)
+
+    def test_publish_failure_fails_the_run(self):
+        with mock.patch('core.update_db._publish_crawl_run', side_effect=ValueError):
+            with self.assertRaises(ValueError), self.assertLogs('core.update_db', 'ERROR'):
+                async_to_sync(crawl_shard)('brest', 'autobus')
+        self.assertEqual(CrawlRun.objects.get().status, 'failed')
+
+
+class CrawlRunTest(TestCase):
+
+    def setUp(self):
+        self.crawl_run = CrawlRun.objects.create(
+            city='brest', transport='autobus', status='failed', bus_names=['1', '2'],
+        )
+        for bus_name in ('1', '2'):
+            Bus.objects.create(name=bus_name, refreshed_at=timezone.now() - timedelta(days=1))
+            CrawlUnit.objects.create(run=self.crawl_run, bus_name=bus_name, status='done', data={'route': None})
+            CrawlUnit.objects.create(run=self.crawl_run, bus_name=bus_name, direction_name='A - B', status='done')
+
+    def test_units_of_routes_refreshed_since_are_reset(self):
+        Bus.objects.filter(name='1').update(refreshed_at=timezone.now() + timedelta(minutes=1))
+        _reset_stale_units(self.crawl_run)
+        self.assertEqual(set(self.crawl_run.units.values_list('bus_name', 'direction_name', 'status')), {
+            ('1', '', 'pending'), ('2', '', 'done'), ('2', 'A - B', 'done'),
+        })
+        self.assertEqual(self.crawl_run.units.get(bus_name='1').data, {})
+
+    def test_unfinished_run_is_resumed(self):
+        self.assertEqual(_get_crawl_run('brest', 'autobus', full=False), self.crawl_run)
+        self.crawl_run.refresh_from_db()
+        self.assertEqual(self.crawl_run.status, 'running')
+
+    def test_full_crawl_does_not_resume_a_partial_run(self):
+        crawl_run = _get_crawl_run('brest', 'autobus', full=True)
+        self.assertNotEqual(crawl_run, self.crawl_run)
+        self.assertTrue(crawl_run.full)
+        self.crawl_run.refresh_from_db()
+        self.assertEqual(self.crawl_run.status, 'abandoned')
+
+    def test_old_runs_are_pruned(self):
+        CrawlRun.objects.filter(id=self.crawl_run.id).update(started_at=timezone.now() - timedelta(days=1))
+        _get_crawl_run('brest', 'autobus', full=False)
+        self.assertFalse(CrawlRun.objects.filter(id=self.crawl_run.id).exists())
+        self.assertFalse(CrawlUnit.objects.filter(run_id=self.crawl_run.id).exists())
@@ -0,0 +1,24 @@
+def get_fixed_text_times(text_times):
+    fixed_text_times = []
+    for text_time in text_times:
+        if len(text_time) == 11:
+            text_time = get_fixed_two_text_times(text_time)
+            fixed_text_times.extend(text_time)
+        else:
+            text_time = get_fixed_59_text_time(text_time)
+            fixed_text_times.append(text_time)
+    return fixed_text_times
+
+
+def get_fixed_59_text_time(text_time):
+    if int(text_time.split(":")[1]) > 59:
+        return f"{text_time.split(':')[0]}:59"
+    return text_time
+
+
+def get_fixed_two_text_times(text_time):
+    if len(text_time) == 11:
+        first_text_time = get_fixed_59_text_time(text_time[:5])
+        second_text_time = get_fixed_59_text_time(text_time[6:11])
+        return [first_text_time, second_text_time]
+    return text_time
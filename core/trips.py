@@ -0,0 +1,142 @@
+from bisect import bisect_right
+from datetime import datetime, timedelta
+from statistics import median
+
+from django.db import transaction
+
+from .models import DAY_TYPES, BusStop, Trip, TripException
+
+# A bus stop time belongs to a trip when it is at most this many minutes away from the time the trip is expected there
+TRIP_MATCH_TOLERANCE = 5
+
+
+def get_day_type(date):
+    return DAY_TYPES[date.weekday()][0]
+
+
+def text_time_to_minutes(text_time):
+    hours, minutes = text_time.split(":")
+    return int(hours) * 60 + int(minutes)
+
+
+def derive_trips(timetables):
+    offsets = []
+    trips = []
+    for bus_stop_index, timetable in enumerate(timetables):
+        bus_stop_times = sorted(text_time_to_minutes(x) for x in timetable)
+        previous_times = [
+            trip['times'][-1] if trip['times'][-1] is not None else trip['departure'] + offsets[-1] for trip in trips
+        ]
+        travel_time = _get_travel_time(previous_times, bus_stop_times)
+        matched_times, unmatched_times = _match_times(previous_times, bus_stop_times, travel_time)
+        if matched_times:
+            offset = round(median(time - trips[index]['departure'] for index, time in matched_times.items()))
+        else:
+            offset = offsets[-1] + travel_time if offsets else 0
+        for index, trip in enumerate(trips):
+            trip['times'].append(matched_times.get(index))
+        for time in unmatched_times:
+            trips.append({'departure': time - offset, 'times': [None] * bus_stop_index + [time]})
+        offsets.append(offset)
+    return offsets, [
+        {
+            'departure': trip['departure'],
+            'exceptions': {
+                index: time for index, time in enumerate(trip['times']) if time != trip['departure'] + offsets[index]
+            },
+        }
+        for trip in trips
+    ]
+
+
+def _get_travel_time(previous_times, bus_stop_times):
+    if not previous_times or not bus_stop_times:
+        return 0
+    previous_times = sorted(previous_times)
+    if len(previous_times) == len(bus_stop_times):
+        travel_time = round(median(time - previous_time for previous_time, time in zip(previous_times, bus_stop_times)))
+        # Negative when some buses pass midnight between the two bus stops and pairing sorted times shifts by one
+        if travel_time >= 0:
+            return travel_time
+    travel_times = []
+    for time in bus_stop_times:
+        index = bisect_right(previous_times, time)
+        if index:
+            travel_times.append(time - previous_times[index - 1])
+    return max(round(median(travel_times)), 0) if travel_times else 0
+
+
+def _match_times(previous_times, bus_stop_times, travel_time):
+    trip_indexes = sorted(range(len(previous_times)), key=lambda index: previous_times[index])
+    expected_times = [previous_times[index] + travel_time for index in trip_indexes]
+    matched_times = {}
+    unmatched_times = []
+    position = 0
+    for time in bus_stop_times:
+        while position < len(expected_times) and expected_times[position] < time - TRIP_MATCH_TOLERANCE:
+            position += 1
+        # A bus never reaches the next bus stop before it left the previous one
+        if (position < len(expected_times) and abs(expected_times[position] - time) <= TRIP_MATCH_TOLERANCE
+                and time >= previous_times[trip_indexes[position]]):
+            matched_times[trip_indexes[position]] = time
+            position += 1
+        else:
+            unmatched_times.append(time)
+    return matched_times, unmatched_times
+
+
+def save_trips(direction, day_type, bus_stops, timetables):
+    offsets, trips = derive_trips(timetables)
+    with transaction.atomic():
+        direction.trips.filter(day_type=day_type).delete()
+        created_trips = Trip.objects.bulk_create([
+            Trip(direction=direction, day_type=day_type, departure=trip['departure']) for trip in trips
+        ])
+        TripException.objects.bulk_create([
+            TripException(trip=created_trip, bus_stop=bus_stops[index], time=time)
+            for created_trip, trip in zip(created_trips, trips)
+            for index, time in trip['exceptions'].items()
+        ])
+        for bus_stop, offset in zip(bus_stops, offsets):
+            bus_stop.offsets[day_type] = offset
+        BusStop.objects.bulk_update(bus_stops, ['offsets', 'timetable_hashes'])
+
+
+def load_trips(trips, exceptions):
+    trip_exceptions = {}
+    for trip_id, bus_stop_id, time in exceptions.values_list('trip_id', 'bus_stop_id', 'time'):
+        trip_exceptions.setdefault(trip_id, {})[bus_stop_id] = time
+    trips_by_direction_and_day_type = {}
+    for trip_id, direction_id, day_type, departure in trips.values_list('id', 'direction_id', 'day_type', 'departure'):
+        trips_by_direction_and_day_type.setdefault((direction_id, day_type), []).append(
+            (departure, trip_exceptions.get(trip_id, {}))
+        )
+    return trips_by_direction_and_day_type
+
+
+def get_bus_stop_times(trips, bus_stop_id, offset):
+    times = []
+    for departure, exceptions in trips:
+        time = exceptions[bus_stop_id] if bus_stop_id in exceptions else departure + offset
+        if time is not None:
+            times.append(time)
+    return sorted(times)
+
+
+def get_schedule(trips_by_direction_and_day_type, bus_stop_id, direction_id, offsets, dates):
+    schedule = []
+    for date in dates:
+        day_type = get_day_type(date)
+        trips = trips_by_direction_and_day_type.get((direction_id, day_type), [])
+        midnight = datetime.combine(date.date(), datetime.min.time())
+        times = get_bus_stop_times(trips, bus_stop_id, offsets.get(day_type, 0))
+        schedule.extend(midnight + timedelta(minutes=x) for x in times)
+    return schedule
+
+
+def get_bus_stop_schedule(bus_stop, dates):
+    day_types = [get_day_type(date) for date in dates]
+    trips = Trip.objects.filter(direction_id=bus_stop.direction_id, day_type__in=day_types)
+    exceptions = TripException.objects.filter(trip__in=trips, bus_stop=bus_stop)
+    trips_by_direction_and_day_type = load_trips(trips, exceptions)
+    return get_schedule(trips_by_direction_and_day_type, bus_stop.id, bus_stop.direction_id, bus_stop.offsets, dates)
@@ -1,161 +1,426 @@
 import asyncio
-import re
+import hashlib
+import json
+import logging
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime, timedelta
 
 from bs4 import BeautifulSoup
 import aiohttp
 
-from django.utils.timezone import make_aware
+from django.conf import settings
+from django.db import connections, transaction
+from django.db.models import Exists, OuterRef
+from django.utils import timezone
 from asgiref.sync import sync_to_async
-from .models import Bus, BusStop, Direction
+from .models import DAY_TYPES, Bus, BusStop, CrawlRun, CrawlUnit, Direction
+from .text_times import get_fixed_text_times
+from .trips import get_day_type, save_trips
 
+logger = logging.getLogger(__name__)
 
-MAIN_URL = "https://kogda.by/routes/brest/autobus/"
+MAIN_URL = "https://kogda.by/routes/{city}/{transport}/"
+TIMETABLE_URL = "https://kogda.by/api/getTimetable"
+HEADERS = {'User-Agent': 'Mozilla/5.0'}
 
 
-async def get_names_of_buses(session):
-    url = MAIN_URL
-    async with session.get(url, headers={'User-Agent': 'Mozilla/5.0'}) as response:
+async def get_names_of_buses(city, transport, session):
+    url = MAIN_URL.format(city=city, transport=transport)
+    async with session.get(url, headers=HEADERS) as response:
+        response.raise_for_status()
         text = await response.text()
-        soup = BeautifulSoup(text, 'html.parser')
-        names = soup.find_all('a', class_='btn btn-primary bold route')
-        return [x.text.strip() for x in names]
-
-
-async def create_buses(session):
-    buses = []
-    names_of_buses = await get_names_of_buses(session)
-    for name_of_bus in names_of_buses:
-        bus = await sync_to_async(Bus.objects.create)(name=name_of_bus)
-        buses.append(bus)
-    return buses
-
-
-async def get_names_of_directions(bus, session):
-    url = MAIN_URL + f"{bus.name}/"
-    async with session.get(url, headers={'User-Agent': 'Mozilla/5.0'}) as response:
+    soup = BeautifulSoup(text, 'html.parser')
+    names = [x.text.strip() for x in soup.find_all('a', class_='btn btn-primary bold route')]
+    if not names:
+        raise ValueError(f"No routes found at {url}")
+    return names
+
+
+def _save_buses(city, transport, names_of_buses):
+    if not names_of_buses:
+        raise ValueError(f"Refusing to delete every route of {city}/{transport}")
+    Bus.objects.filter(city=city, transport=transport).exclude(name__in=names_of_buses).delete()
+    return [
+        Bus.objects.get_or_create(name=name_of_bus, city=city, transport=transport)[0]
+        for name_of_bus in names_of_buses
+    ]
+
+
+async def update_buses(city, transport, session):
+    names_of_buses = await get_names_of_buses(city, transport, session)
+    return await sync_to_async(_save_buses)(city, transport, names_of_buses)
+
+
+async def get_route(bus, session):
+    url = MAIN_URL.format(city=bus.city, transport=bus.transport) + f"{bus.name}/"
+    headers = dict(HEADERS)
+    if bus.etag:
+        headers['If-None-Match'] = bus.etag
+    if bus.last_modified:
+        headers['If-Modified-Since'] = bus.last_modified
+    async with session.get(url, headers=headers) as response:
+        if response.status == 304:
+            return None, bus.etag, bus.last_modified
+        response.raise_for_status()
         soup = BeautifulSoup(await response.text(), 'html.parser')
-        names = soup.find_all('a', {'data-parent': '#directions'})
-        return [x.text.strip() for x in names]
+        etag = response.headers.get('ETag', '')
+        last_modified = response.headers.get('Last-Modified', '')
+    route = {}
+    for direction_link in soup.find_all('a', {'data-parent': '#directions'}):
+        bus_stops = soup.select(f"{direction_link.attrs['href']} > ul > li")
+        route[direction_link.text.strip()] = [x.find("a").text.strip() for x in bus_stops]
+    if not route or not all(route.values()):
+        raise ValueError(f"No directions or bus stops found at {url}")
+    return route, etag, last_modified
 
 
-async def create_directions(bus, session):
-    directions = []
-    names_of_directions = await get_names_of_directions(bus, session)
-    for name_of_direction in names_of_directions:
-        direction = await sync_to_async(Direction.objects.create)(name=name_of_direction, bus=bus)
-        directions.append(direction)
-    return directions
+def get_hash(data):
+    return hashlib.sha256(json.dumps(data, ensure_ascii=False, sort_keys=True).encode()).hexdigest()
 
 
-async def get_names_of_bus_stops(direction, session):
-    url = MAIN_URL + f"{direction.bus.name}/"
-    async with session.get(url, headers={'User-Agent': 'Mozilla/5.0'}) as response:
-        soup = BeautifulSoup(await response.text(), 'html.parser')
-        direction_number = soup.find("a", text=re.compile(direction.name)).attrs['href']
-        bus_stops = soup.select(f"{direction_number} > ul > li")
-        return [x.find("a").text.strip() for x in bus_stops]
+def get_dates():
+    date_for_today = datetime.now()
+    return [date_for_today + timedelta(days=x) for x in range(len(DAY_TYPES))]
 
 
-async def get_schedule(bus_stop, session):
-    date_for_today = datetime.now()
-    schedules_for_today = await get_schedule_for_date(bus_stop, date_for_today, session)
-    date_for_tomorrow = datetime.now() + timedelta(days=1)
-    schedules_for_tomorrow = await get_schedule_for_date(bus_stop, date_for_tomorrow, session)
-    return schedules_for_today + schedules_for_tomorrow
+def get_sample_bus_stops(bus_stops):
+    indexes = sorted({0, len(bus_stops) // 2, len(bus_stops) - 1})
+    return [bus_stops[index] for index in indexes]
 
 
-async def get_schedule_for_date(bus_stop, date, session):
-    url = "https://kogda.by/api/getTimetable"
-    date_string = date.strftime("%Y-%m-%d")
+async def get_timetable_for_date(bus, direction_name, bus_stop_name, date, session):
     params = {
-        "city": "brest",
-        "transport": "autobus",
-        "route": bus_stop.direction.bus.name,
-        "direction": bus_stop.direction.name,
-        "busStop": bus_stop.name,
-        "date": date_string,
+        "city": bus.city,
+        "transport": bus.transport,
+        "route": bus.name,
+        "direction": direction_name,
+        "busStop": bus_stop_name,
+        "date": date.strftime("%Y-%m-%d"),
     }
-    async with session.get(url, params=params, headers={'User-Agent': 'Mozilla/5.0'}) as response:
+    async with session.get(TIMETABLE_URL, params=params, headers=HEADERS) as response:
+        response.raise_for_status()
         timetable = await response.json()
-        timetable = await get_fixed_text_times(timetable["timetable"])
-    return [make_aware(datetime.strptime(x + " " + date_string, "%H:%M %Y-%m-%d")) for x in timetable]
-
-
-async def get_fixed_text_times(text_times):
-    fixed_text_times = []
-    for text_time in text_times:
-        if len(text_time) == 11:
-            text_time = await get_fixed_two_text_times(text_time)
-            fixed_text_times.extend(text_time)
+        return get_fixed_text_times(timetable["timetable"])
+
+
+async def is_timetable_changed(bus, direction_name, bus_stops, date, session):
+    day_type = get_day_type(date)
+    for bus_stop in get_sample_bus_stops(bus_stops):
+        timetable = await get_timetable_for_date(bus, direction_name, bus_stop.name, date, session)
+        if get_hash(timetable) != bus_stop.timetable_hashes.get(day_type):
+            return True
+    return False
+
+
+async def get_direction_timetables(bus, direction_name, bus_stops, day_types, full, is_full_crawl, session):
+    timetables_by_day_type = {}
+    if not bus_stops:
+        return timetables_by_day_type
+    # Every day of the coming week is fetched when the route is new or changed and on a full crawl. In between only
+    # today and tomorrow are checked, so the day before a date is refreshed catches its holiday or new schedule
+    for index, date in enumerate(get_dates()):
+        day_type = get_day_type(date)
+        # Sampled stops are compared on every refresh, and every FULL_CRAWL_INTERVAL_DAYS all stops are fetched anyway
+        # in case a change left the sampled ones untouched
+        if (full or is_full_crawl or day_type not in day_types
+                or (index < 2 and await is_timetable_changed(bus, direction_name, bus_stops, date, session))):
+            timetables_by_day_type[day_type] = [
+                await get_timetable_for_date(bus, direction_name, bus_stop.name, date, session)
+                for bus_stop in bus_stops
+            ]
+    return timetables_by_day_type
+
+
+def _save_timetables(direction, bus_stops, timetables_by_day_type):
+    for day_type, timetables in timetables_by_day_type.items():
+        for bus_stop, timetable in zip(bus_stops, timetables):
+            bus_stop.timetable_hashes[day_type] = get_hash(timetable)
+        save_trips(direction, day_type, bus_stops, timetables)
+
+
+def _save_bus_stops(direction, names_of_bus_stops):
+    existing_bus_stops = {}
+    for bus_stop in direction.bus_stops.all():
+        existing_bus_stops.setdefault(bus_stop.name, []).append(bus_stop)
+    for position, name_of_bus_stop in enumerate(names_of_bus_stops):
+        if existing_bus_stops.get(name_of_bus_stop):
+            bus_stop = existing_bus_stops[name_of_bus_stop].pop(0)
+            bus_stop.position = position
+            bus_stop.save(update_fields=['position'])
         else:
-            text_time = await get_fixed_59_text_time(text_time)
-            fixed_text_times.append(text_time)
-    return fixed_text_times
-
+            BusStop.objects.create(name=name_of_bus_stop, direction=direction, position=position)
+    stale_bus_stop_ids = [bus_stop.id for bus_stops in existing_bus_stops.values() for bus_stop in bus_stops]
+    BusStop.objects.filter(id__in=stale_bus_stop_ids).delete()
 
-async def get_fixed_59_text_time(text_time):
-    if int(text_time.split(":")[1]) > 59:
-        return f"{text_time.split(':')[0]}:59"
-    return text_time
 
+def _save_route(bus, route):
+    if not route:
+        raise ValueError(f"Refusing to delete every direction of {bus}")
+    with transaction.atomic():
+        bus.directions.exclude(name__in=route).delete()
+        for name_of_direction, names_of_bus_stops in route.items():
+            direction = Direction.objects.get_or_create(name=name_of_direction, bus=bus)[0]
+            _save_bus_stops(direction, names_of_bus_stops)
+        bus.page_hash = get_hash(route)
+        bus.save()
 
-async def get_fixed_two_text_times(text_time):
-    if len(text_time) == 11:
-        first_text_time = await get_fixed_59_text_time(text_time[:5])
-        second_text_time = await get_fixed_59_text_time(text_time[6:11])
-        return [first_text_time, second_text_time]
-    return text_time
 
-
-async def create_bus_stops(direction, session):
-    bus_stops = []
-    names_of_bus_stops = await get_names_of_bus_stops(direction, session)
-    for name_of_bus_stop in names_of_bus_stops:
-        bus_stop = await sync_to_async(BusStop.objects.create)(name=name_of_bus_stop, direction=direction)
-        bus_stop.schedule = await get_schedule(bus_stop, session)
-        await sync_to_async(bus_stop.save)()
-        bus_stops.append(bus_stop)
-    return bus_stops
-
-
-async def create_directions_and_bus_stops(bus, session):
-    directions = await create_directions(bus, session)
-    for direction in directions:
-        await create_bus_stops(direction, session)
-
-
-def _delete_buses():
-    Bus.objects.all().delete()
+def _get_directions(bus):
+    directions = []
+    for direction in bus.directions.all():
+        bus_stops = list(direction.bus_stops.all())
+        day_types = set(direction.trips.values_list('day_type', flat=True))
+        directions.append((direction, bus_stops, day_types))
+    return directions
 
 
-def _delete_directions():
-    Direction.objects.all().delete()
+def is_full_crawl_due(bus):
+    full_crawl_interval = timedelta(days=settings.FULL_CRAWL_INTERVAL_DAYS)
+    return bus.crawled_at is None or bus.crawled_at < timezone.now() - full_crawl_interval
+
+
+def _save_refreshed_bus(bus, is_full_crawl):
+    if is_full_crawl:
+        bus.crawled_at = timezone.now()
+    bus.refreshed_at = timezone.now()
+    bus.refresh_failed_at = None
+    bus.refresh_failures = 0
+    bus.save()
+
+
+def _get_crawl_run(city, transport, full):
+    unfinished_runs = CrawlRun.objects.filter(city=city, transport=transport, status__in=['running', 'failed'])
+    crawl_run = unfinished_runs.order_by('-started_at').first()
+    max_age = timedelta(hours=settings.CRAWL_RUN_MAX_AGE_HOURS)
+    # Units already done in a run that was not full skipped unchanged timetables, so a full crawl starts over
+    if crawl_run and crawl_run.started_at >= timezone.now() - max_age and (crawl_run.full or not full):
+        crawl_run.status = 'running'
+        crawl_run.save()
+        _reset_stale_units(crawl_run)
+        return crawl_run
+    unfinished_runs.update(status='abandoned', finished_at=timezone.now())
+    finished_runs = CrawlRun.objects.filter(city=city, transport=transport, status__in=['published', 'abandoned'])
+    finished_runs.filter(started_at__lt=timezone.now() - max_age).delete()
+    return CrawlRun.objects.create(city=city, transport=transport, full=full)
+
+
+def _reset_stale_units(crawl_run):
+    # A route refreshed since its units were crawled would be published with outdated data, so it is crawled again
+    refreshed_buses = Bus.objects.filter(city=crawl_run.city, transport=crawl_run.transport, name=OuterRef('bus_name'))
+    refreshed_buses = refreshed_buses.filter(refreshed_at__gt=OuterRef('updated_at'))
+    is_refreshed_since = Exists(refreshed_buses)
+    stale_bus_names = set(crawl_run.units.filter(is_refreshed_since, status='done').values_list('bus_name', flat=True))
+    stale_units = crawl_run.units.filter(bus_name__in=stale_bus_names)
+    # Directions depend on the route page, which is downloaded again
+    stale_units.exclude(direction_name='').delete()
+    stale_units.update(status='pending', attempts=0, data={}, error='')
+
+
+def _get_buses(city, transport):
+    return {bus.name: bus for bus in Bus.objects.filter(city=city, transport=transport)}
+
+
+def _get_directions_by_name(buses):
+    return {
+        (bus.name, direction.name): (direction, bus_stops, day_types)
+        for bus in buses
+        for direction, bus_stops, day_types in _get_directions(bus)
+    }
 
 
-def _delete_bus_stops():
-    BusStop.objects.all().delete()
+def _get_route_units(crawl_run):
+    existing_bus_names = set(crawl_run.units.filter(direction_name='').values_list('bus_name', flat=True))
+    CrawlUnit.objects.bulk_create([
+        CrawlUnit(run=crawl_run, bus_name=bus_name)
+        for bus_name in crawl_run.bus_names if bus_name not in existing_bus_names
+    ])
+    return {unit.bus_name: unit for unit in crawl_run.units.filter(direction_name='')}
+
+
+def _get_direction_units(crawl_run, route_units, directions_by_name):
+    existing_names = set(crawl_run.units.exclude(direction_name='').values_list('bus_name', 'direction_name'))
+    new_units = []
+    for route_unit in route_units.values():
+        if route_unit.status != 'done':
+            continue
+        route = route_unit.data['route']
+        if route is not None:
+            names_of_directions = list(route)
+        else:
+            names_of_directions = [name for bus_name, name in directions_by_name if bus_name == route_unit.bus_name]
+        new_units.extend(
+            CrawlUnit(run=crawl_run, bus_name=route_unit.bus_name, direction_name=name_of_direction)
+            for name_of_direction in names_of_directions
+            if (route_unit.bus_name, name_of_direction) not in existing_names
+        )
+    CrawlUnit.objects.bulk_create(new_units)
+    return list(crawl_run.units.exclude(direction_name=''))
+
+
+async def crawl_unit(unit, crawl):
+    try:
+        unit.data = await crawl
+        unit.status = 'done'
+        unit.error = ''
+    except Exception as error:
+        logger.warning("Crawl of %s %s failed", unit.bus_name, unit.direction_name, exc_info=error)
+        unit.status = 'failed'
+        unit.error = repr(error)
+    unit.attempts += 1
+    await sync_to_async(unit.save)()
+
+
+async def crawl_route(bus, full, session):
+    route, etag, last_modified = await get_route(bus, session)
+    if route is not None and get_hash(route) == bus.page_hash:
+        route = None
+    full = full or route is not None
+    return {
+        'route': route,
+        'etag': etag,
+        'last_modified': last_modified,
+        'full': full,
+        'is_full_crawl': full or is_full_crawl_due(bus),
+    }
 
 
-async def delete_all_objects():
-    buses = await sync_to_async(Bus.objects.all)()
-    await sync_to_async(buses.delete)()
-    directions = await sync_to_async(Direction.objects.all)()
-    await sync_to_async(directions.delete)()
-    bus_stops = await sync_to_async(BusStop.objects.all)()
-    await sync_to_async(bus_stops.delete)()
+async def crawl_direction(bus, direction_name, route_data, directions_by_name, session):
+    if route_data['route'] is not None:
+        bus_stops = [BusStop(name=name_of_bus_stop) for name_of_bus_stop in route_data['route'][direction_name]]
+        day_types = set()
+    else:
+        _, bus_stops, day_types = directions_by_name[(bus.name, direction_name)]
+    timetables_by_day_type = await get_direction_timetables(
+        bus, direction_name, bus_stops, day_types, route_data['full'], route_data['is_full_crawl'], session
+    )
+    return {
+        'bus_stop_names': [bus_stop.name for bus_stop in bus_stops],
+        'timetables': timetables_by_day_type,
+    }
 
 
-async def update_all_db():
+def _save_crawled_direction(bus, direction_name, direction_data):
+    direction = bus.directions.get(name=direction_name)
+    bus_stops = list(direction.bus_stops.all())
+    if [bus_stop.name for bus_stop in bus_stops] != direction_data['bus_stop_names']:
+        raise ValueError(f"Bus stops of {bus.name} {direction_name} changed during the crawl")
+    _save_timetables(direction, bus_stops, direction_data['timetables'])
+
+
+def _save_refresh(bus, route_data, directions_data):
+    with transaction.atomic():
+        bus.etag = route_data['etag']
+        bus.last_modified = route_data['last_modified']
+        if route_data['route'] is not None:
+            _save_route(bus, route_data['route'])
+        for direction_name, direction_data in directions_data.items():
+            _save_crawled_direction(bus, direction_name, direction_data)
+        _save_refreshed_bus(bus, route_data['is_full_crawl'])
+
+
+async def refresh_bus(bus, session, full=False):
+    # Everything is downloaded before anything is saved, so a half-fetched route never reaches the database
+    route_data = await crawl_route(bus, full, session)
+    directions_by_name = await sync_to_async(_get_directions_by_name)([bus])
+    if route_data['route'] is not None:
+        names_of_directions = list(route_data['route'])
+    else:
+        names_of_directions = [name_of_direction for _, name_of_direction in directions_by_name]
+    directions_data = {}
+    for name_of_direction in names_of_directions:
+        directions_data[name_of_direction] = await crawl_direction(
+            bus, name_of_direction, route_data, directions_by_name, session
+        )
+    await sync_to_async(_save_refresh)(bus, route_data, directions_data)
+
+
+def _publish_crawl_run(crawl_run):
+    with transaction.atomic():
+        buses = {bus.name: bus for bus in _save_buses(crawl_run.city, crawl_run.transport, crawl_run.bus_names)}
+        route_units = {unit.bus_name: unit for unit in crawl_run.units.filter(direction_name='')}
+        for bus_name, unit in route_units.items():
+            bus = buses[bus_name]
+            bus.etag = unit.data['etag']
+            bus.last_modified = unit.data['last_modified']
+            if unit.data['route'] is not None:
+                _save_route(bus, unit.data['route'])
+        for unit in crawl_run.units.exclude(direction_name=''):
+            _save_crawled_direction(buses[unit.bus_name], unit.direction_name, unit.data)
+        for bus_name, unit in route_units.items():
+            _save_refreshed_bus(buses[bus_name], unit.data['is_full_crawl'])
+        crawl_run.units.all().delete()
+        crawl_run.status = 'published'
+        crawl_run.finished_at = timezone.now()
+        crawl_run.save()
+
+
+def _fail_crawl_run(crawl_run):
+    crawl_run.status = 'failed'
+    crawl_run.save()
+
+
+async def crawl_shard(city, transport, full=False):
     now = datetime.now()
-    await delete_all_objects()
+    crawl_run = await sync_to_async(_get_crawl_run)(city, transport, full)
+    buses = await sync_to_async(_get_buses)(city, transport)
+    directions_by_name = await sync_to_async(_get_directions_by_name)(list(buses.values()))
+    is_complete = False
     async with aiohttp.ClientSession() as session:
-        buses = await create_buses(session)
-        tasks = []
-        for bus in buses:
-            task = asyncio.create_task(create_directions_and_bus_stops(bus, session))
-            tasks.append(task)
-        await asyncio.gather(*tasks)
-        now2 = datetime.now()
-        duration = now2 - now
-        return duration.total_seconds()
+        if not crawl_run.bus_names:
+            crawl_run.bus_names = await get_names_of_buses(city, transport, session)
+            await sync_to_async(crawl_run.save)()
+        new_buses = {
+            bus_name: Bus(name=bus_name, city=city, transport=transport)
+            for bus_name in crawl_run.bus_names if bus_name not in buses
+        }
+        buses = {**buses, **new_buses}
+        for _ in range(settings.CRAWL_UNIT_ATTEMPTS):
+            route_units = await sync_to_async(_get_route_units)(crawl_run)
+            await asyncio.gather(*(
+                crawl_unit(unit, crawl_route(buses[unit.bus_name], crawl_run.full, session))
+                for unit in route_units.values() if unit.status != 'done'
+            ))
+            direction_units = await sync_to_async(_get_direction_units)(crawl_run, route_units, directions_by_name)
+            await asyncio.gather(*(
+                crawl_unit(unit, crawl_direction(
+                    buses[unit.bus_name], unit.direction_name, route_units[unit.bus_name].data, directions_by_name,
+                    session
+                ))
+                for unit in direction_units if unit.status != 'done'
+            ))
+            units = list(route_units.values()) + direction_units
+            is_complete = all(unit.status == 'done' for unit in units)
+            if is_complete:
+                break
+    if not is_complete:
+        await sync_to_async(_fail_crawl_run)(crawl_run)
+        raise RuntimeError(f"Crawl of {city}/{transport} did not finish, run it again to resume")
+    try:
+        await sync_to_async(_publish_crawl_run)(crawl_run)
+    except Exception:
+        await sync_to_async(_fail_crawl_run)(crawl_run)
+        raise
+    now2 = datetime.now()
+    duration = now2 - now
+    return duration.total_seconds()
+
+
+def run_shard(city, transport, full=False):
+    connections.close_all()
+    return asyncio.run(crawl_shard(city, transport, full))
+
+
+def update_shards(shards, processes, full=False):
+    connections.close_all()
+    context = multiprocessing.get_context('fork')
+    with ProcessPoolExecutor(max_workers=processes, mp_context=context) as executor:
+        futures = [executor.submit(run_shard, city, transport, full) for city, transport in shards]
+        results = []
+        for (city, transport), future in zip(shards, futures):
+            try:
+                results.append(future.result())
+            except Exception as error:
+                logger.error("Crawl of %s/%s failed", city, transport, exc_info=error)
+                results.append(error)
+        return results
@@ -0,0 +1,147 @@
+import time
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from datetime import datetime
+from threading import Lock
+
+import requests
+from django.conf import settings
+
+from .text_times import get_fixed_text_times
+from .trips import get_bus_stop_schedule
+
+TIMETABLE_URL = "https://kogda.by/api/getTimetable"
+HEADERS = {'User-Agent': 'Mozilla/5.0'}
+
+
+class UpstreamError(Exception):
+    pass
+
+
+class DeadlineExceeded(UpstreamError):
+    pass
+
+
+class CircuitBreaker:
+
+    def __init__(self, failure_threshold, recovery_timeout):
+        self.failure_threshold = failure_threshold
+        self.recovery_timeout = recovery_timeout
+        self._failures = 0
+        self._opened_at = None
+        self._lock = Lock()
+
+    def is_open(self):
+        with self._lock:
+            if self._opened_at is None:
+                return False
+            if time.monotonic() - self._opened_at < self.recovery_timeout:
+                return True
+            # Half-open: let a single trial request through and wait for its outcome
+            self._opened_at = time.monotonic()
+            return False
+
+    def has_recent_failures(self):
+        with self._lock:
+            return self._failures > 0
+
+    def record_success(self):
+        with self._lock:
+            self._failures = 0
+            self._opened_at = None
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            if self._failures >= self.failure_threshold:
+                self._opened_at = time.monotonic()
+
+
+circuit_breaker = CircuitBreaker(settings.UPSTREAM_FAILURE_THRESHOLD, settings.UPSTREAM_RECOVERY_TIMEOUT)
+executor = ThreadPoolExecutor(max_workers=settings.UPSTREAM_MAX_WORKERS)
+# Runs whole lookups, which wait on requests in the executor above, so the two must not share threads
+lookup_executor = ThreadPoolExecutor(max_workers=settings.UPSTREAM_MAX_WORKERS)
+
+
+class TimetableClient:
+
+    def __init__(self, deadline):
+        self.deadline = deadline
+
+    def get_schedules(self, bus_stop, dates):
+        # Dates are looked up at the same time so that each one gets the whole budget, not what the previous one left
+        futures = [lookup_executor.submit(self._get_live_schedule, self._get_params(bus_stop, date)) for date in dates]
+        schedules = []
+        for date, future in zip(dates, futures):
+            try:
+                schedules.append(future.result())
+            except UpstreamError:
+                schedules.append(self._get_stored_schedule(bus_stop, date))
+        return schedules
+
+    @staticmethod
+    def _get_params(bus_stop, date):
+        return {
+            "city": bus_stop.direction.bus.city,
+            "transport": bus_stop.direction.bus.transport,
+            "route": bus_stop.direction.bus.name,
+            "direction": bus_stop.direction.name,
+            "busStop": bus_stop.name,
+            "date": date.strftime("%Y-%m-%d"),
+        }
+
+    def _get_live_schedule(self, params):
+        timetable = self._get_timetable(params)
+        try:
+            return [
+                datetime.strptime(x + " " + params["date"], "%H:%M %Y-%m-%d") for x in get_fixed_text_times(timetable)
+            ]
+        except (IndexError, ValueError) as error:
+            raise UpstreamError(f"Invalid timetable {timetable}") from error
+
+    @staticmethod
+    def _get_stored_schedule(bus_stop, date):
+        return get_bus_stop_schedule(bus_stop, [date])
+
+    def _get_timetable(self, params):
+        if self._get_remaining_time() <= 0:
+            raise DeadlineExceeded("No time left for a live timetable request")
+        if circuit_breaker.is_open():
+            raise UpstreamError("Circuit breaker is open")
+        # A struggling upstream gets one request per lookup, hedging would only multiply its load
+        max_attempts = 1 if circuit_breaker.has_recent_failures() else settings.UPSTREAM_MAX_ATTEMPTS
+        budgets = {executor.submit(self._request_timetable, params): self._get_remaining_time()}
+        futures = set(budgets)
+        errors = []
+        while futures:
+            remaining_time = self._get_remaining_time()
+            if remaining_time <= 0:
+                break
+            timeout = remaining_time
+            if len(budgets) < max_attempts:
+                timeout = min(remaining_time, settings.UPSTREAM_HEDGE_DELAY)
+            done, futures = wait(futures, timeout=timeout, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    circuit_breaker.record_success()
+                    return future.result()
+                errors.append(future.exception())
+            if len(budgets) < max_attempts and self._get_remaining_time() > 0:
+                future = executor.submit(self._request_timetable, params)
+                budgets[future] = self._get_remaining_time()
+                futures.add(future)
+        # Attempts sent with only the scraps of the caller's budget say nothing about the health of the upstream
+        is_timed_out = any(budgets[future] >= settings.UPSTREAM_HEDGE_DELAY for future in futures)
+        if is_timed_out or any(not isinstance(error, DeadlineExceeded) for error in errors):
+            circuit_breaker.record_failure()
+        raise UpstreamError(f"No timetable for {params} within the deadline")
+
+    def _request_timetable(self, params):
+        timeout = self._get_remaining_time()
+        if timeout <= 0:
+            raise DeadlineExceeded("Deadline exceeded before the request was sent")
+        response = requests.get(TIMETABLE_URL, params, headers=HEADERS, timeout=timeout)
+        response.raise_for_status()
+        return response.json()["timetable"]
+
+    def _get_remaining_time(self):
+        return self.deadline - time.monotonic()
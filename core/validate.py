@@ -1,6 +1,8 @@
 def validate(*parameters):
     def validate_parameters_for_decorator():
-        valid_parameters = ["yandex_user", "main_bus_stop", "bus_name", "bus_stop_name", "guiding_bus_stop_name"]
+        valid_parameters = [
+            "yandex_user", "main_bus_stop", "bus_name", "bus_stop_name", "guiding_bus_stop_name", "city_from_command"
+        ]
         if not all(parameter in valid_parameters for parameter in parameters):
             string_with_parameters = " ".join(parameters)
             raise ValueError(f"Invalid parameters {string_with_parameters} in validate decorator")
@@ -24,6 +26,7 @@ def validate(*parameters):
                             "bus_stop_name": "сказать название автобусной остановки",
                             "guiding_bus_stop_name": "сказать название автобусной остановки в сторону которой будет "
                                                      "ехать автобус",
+                            "city_from_command": "назвать город, расписание которого я знаю",
                         }
                         errors.append(parameter_to_error[parameter])
                 return "Извините, для этого вы должны " + errors_to_text(errors)
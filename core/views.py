@@ -1,9 +1,12 @@
+from datetime import datetime
+
 from rest_framework.views import APIView
 from rest_framework.response import Response
 from rest_framework.request import Request
 
+from django.conf import settings
 from django.http import HttpResponse
-from .update_db import update_all_db
+from .departures import departure_index
 from .services import Skill
 
 
@@ -14,11 +17,47 @@ class MainView(APIView):
         return skill.get_response()
 
 
-def index(request):
-    return HttpResponse("Hello World")
+class DeparturesView(APIView):
+    authentication_classes = []
+    permission_classes = []
+
+    def get(self, request: Request) -> Response:
+        bus_stop_ids = request.query_params.get('stops', '').split(',')
+        return self._get_departures_response(request, bus_stop_ids, request.query_params.get('limit'))
+
+    def post(self, request: Request) -> Response:
+        if not isinstance(request.data, dict):
+            return Response({'error': 'body must be an object with stops and limit'}, status=400)
+        return self._get_departures_response(request, request.data.get('stops', []), request.data.get('limit'))
+
+    @staticmethod
+    def _get_departures_response(request, bus_stop_ids, limit):
+        try:
+            if not isinstance(bus_stop_ids, list):
+                raise TypeError('stops must be a list')
+            bus_stop_ids = [int(x) for x in bus_stop_ids]
+            limit = int(limit or settings.DEPARTURES_DEFAULT_LIMIT)
+        except (TypeError, ValueError):
+            return Response({'error': 'stops must be a list of bus stop ids and limit a number'}, status=400)
+        if not bus_stop_ids or len(bus_stop_ids) > settings.DEPARTURES_MAX_STOPS:
+            return Response({'error': f'from 1 to {settings.DEPARTURES_MAX_STOPS} stops can be requested'},
+                            status=400)
+        limit = max(1, min(limit, settings.DEPARTURES_MAX_LIMIT))
+        version = departure_index.get_version()
+        now = datetime.now()
+        headers = {
+            'ETag': f'"{version}-{now.strftime("%Y%m%d%H%M")}"',
+            'Cache-Control': f'public, max-age={60 - now.second}',
+        }
+        if request.headers.get('If-None-Match') == headers['ETag']:
+            return Response(status=304, headers=headers)
+        response = {
+            'version': version,
+            'stops': departure_index.get_departures(bus_stop_ids, limit),
+        }
+        return Response(response, headers=headers)
 
 
-async def update_db(request):
-    update_time = await update_all_db()
-    return HttpResponse(update_time)
+def index(request):
+    return HttpResponse("Hello World")
 